@@ -7,22 +7,37 @@ import torchvision.datasets as dsets
 import torchvision.transforms as transforms
 from torch.autograd import Variable
 import torch.nn.functional as F
-from models import MNIST, CIFAR10, IMAGENET, SimpleMNIST, load_mnist_data, load_cifar10_data, imagenettest, load_model, show_image
+from prediction_index import load_prediction_index
+from oracle import RayCache, RayProbe
+from models import MNIST, CIFAR10, IMAGENET, SimpleMNIST, DevicePolicy, policy_of, unwrap, load_mnist_data, load_cifar10_data, imagenettest, load_model, show_image
+from pipeline import attack_jobs, prefetch
 
 alpha = 0.2
 beta = 0.001
 
-def attack_targeted(model, train_loader, x0, y0, target, alpha = 0.1, beta = 0.001, iterations = 1000, batch_size = 10):
+def attack_targeted(model, train_loader, x0, y0, target, alpha = 0.1, beta = 0.001, iterations = 1000, batch_size = 10, prediction_index = None, ray_cache = False, budget = None):
     """ Attack the original image and return adversarial example of target t
         model: (pytorch model)
         train_dataset: set of training data
         (x0, y0): original image
         t: target
+        prediction_index: PredictionIndex of model on train_loader.dataset; the
+                          candidates are then training images predicted as t
+        ray_cache: answer STEP II queries already decided by a known bracket
+                   along the same direction without querying the model; the
+                   directions searched again are an accepted step (temp_theta
+                   is the next iteration's theta), a carried ttt and the final
+                   theta
+        budget: Budget (queries, seconds, distortion plateau) after which the
+                attack stops and returns the best example found so far
     """
     o_alpha = alpha
+    policy = policy_of(model)
     if (model.predict(x0) != y0):
         print("Fail to classify the image. No need to attack.")
         return x0
+    if budget is not None:
+        budget.start()
     # STEP I: find initial direction (theta, g_theta)
     ''' 
     image, label = Variable(x0.cuda()), y0.cuda() 
@@ -40,38 +55,39 @@ def attack_targeted(model, train_loader, x0, y0, target, alpha = 0.1, beta = 0.0
     #samples = set(random.sample(range(len(train_dataset)), num_samples))
     b_train_size = 1000
     b_best_lbd = float('inf')
-    dim1 = x0.size()[0]
-    dim3 = x0.size()[2]
+    if prediction_index is not None:
+        batches = [prediction_index.load_batch(train_loader.dataset, prediction_index.sample(b_train_size, label = target))]
+    else:
+        batches = train_loader
     #for index in range(batch_size):
-    for i, (xi, yi) in enumerate(train_loader):
+    for i, (xi, yi) in enumerate(batches):
         if i == 1:
             break
-        xi,yi=xi.cuda(),yi.cuda()
+        xi, yi = policy.images(xi), policy.tensor(yi)
         #temp_x0, temp_y0 = x0[index], y0[index]
         temp_x0 = x0 
         #temp_x0 = temp_x0.expand(100,1,28,28)
             
         #b_target = torch.LongTensor([target[index]]).expand(100).cuda()
         #b_target = torch.LongTensor([target]).expand(b_train_size).cuda()
-        b_index = ( target == yi).nonzero().squeeze()
-        if len(b_index.size()) == 0:
+        b_index = ( target == yi).nonzero().view(-1)
+        if b_index.numel() == 0:
             continue
         xi = xi[b_index]
         #b_target = b_target[b_index]
-        temp_x0 = temp_x0.expand(xi.size()).cuda()
+        temp_x0 = policy.images(temp_x0)
         theta = xi - temp_x0
-        initial_lbd = torch.norm(torch.norm(torch.norm(theta,2,1),2,1),2,1)
-        initial_lbd = initial_lbd.unsqueeze(1).unsqueeze(2).expand(xi.size()[0],dim1,dim3).unsqueeze(3).expand(xi.size()[0],dim1,dim3,dim3)
-        theta /= initial_lbd
+        initial_lbd = theta.view(theta.size(0), -1).norm(2, 1)
+        theta /= initial_lbd.view((-1,) + (1,) * (theta.dim() - 1))
         lbd, query_count = initial_fine_grained_binary_search_targeted(model, temp_x0, target, theta, initial_lbd)
         #print(lbd)    
         best_lbd, best_index = torch.min(lbd,0)
         #print(best_lbd)
         best_theta = theta[best_index]
-        if best_lbd[0] < b_best_lbd:
+        if best_lbd.item() < b_best_lbd:
             
             #print(model.predict(x0.cuda()+best_lbd*best_theta))
-            b_best_lbd = best_lbd[0]
+            b_best_lbd = best_lbd.item()
             b_best_theta = best_theta.clone()
             print("--------> Found g() %.4f" %b_best_lbd)
 
@@ -88,21 +104,27 @@ def attack_targeted(model, train_loader, x0, y0, target, alpha = 0.1, beta = 0.0
     theta, g2 = best_theta.clone(), g_theta
     print(model.predict(x0+theta*g2))
     opt_count = 0
+    cache = RayCache(model, x0, lambda label: label == target) if ray_cache else RayProbe(model, x0)
     torch.manual_seed(0)
     for i in range(iterations):
+        if budget is not None and budget.exhausted(query_count + opt_count, g_theta):
+            print("Stopping at iteration %d: %s" % (i, budget.reason))
+            break
         #alpha = 1e-3
         #beta = 1e-3
         u = torch.randn(theta.size())
         u = u/torch.norm(u)
-        g2, count = fine_grained_binary_search_local_targeted(model, x0, target, theta, initial_lbd = g2)
+        g2, count = fine_grained_binary_search_local_targeted(model, x0, target, theta, initial_lbd = g2, cache = cache)
         opt_count += count
+        if g2 < g_theta:
+            best_theta, g_theta = theta.clone(), g2
         ttt = theta+beta * u
         ttt = ttt/torch.norm(ttt)
         ttt = ttt.type(torch.FloatTensor)
-        g1, count = fine_grained_binary_search_local_targeted(model, x0, target, ttt, initial_lbd = g2)
+        g1, count = fine_grained_binary_search_local_targeted(model, x0, target, ttt, initial_lbd = g2, cache = cache)
         opt_count += count
-        temp_output = model.predict(x0+g2*theta)
         if (i+1)%100 == 0:
+            temp_output = cache.along(theta)(g2) if ray_cache else model.predict(x0+g2*theta)
             print("Iteration %3d: g(theta + beta*u) = %.4f g(theta) = %.4f distortion %.4f num_queries %d alpha %.5f beta %.5f output %d" % (i+1, g1, g2, g2, opt_count, alpha, beta, temp_output))
         #if (i+1)%500 ==0:
         #    alpha = alpha*2 
@@ -110,7 +132,7 @@ def attack_targeted(model, train_loader, x0, y0, target, alpha = 0.1, beta = 0.0
         gradient = (g1-g2)/torch.norm(ttt-theta) * u
         temp_theta = theta - alpha*gradient
         temp_theta /= torch.norm(temp_theta)
-        g3, count = fine_grained_binary_search_local_targeted(model, x0, target, temp_theta, initial_lbd = g2)
+        g3, count = fine_grained_binary_search_local_targeted(model, x0, target, temp_theta, initial_lbd = g2, cache = cache)
         if g3 > g1:
             #print("aa")
             theta = ttt
@@ -122,22 +144,28 @@ def attack_targeted(model, train_loader, x0, y0, target, alpha = 0.1, beta = 0.0
                 theta.sub_(alpha*gradient)
             theta /= torch.norm(theta)
 
-    g2, count = fine_grained_binary_search_local_targeted(model, x0, target, theta, initial_lbd = g2)
+    g2, count = fine_grained_binary_search_local_targeted(model, x0, target, theta, initial_lbd = g2, cache = cache)
+    if g2 > g_theta:
+        theta, g2 = best_theta, g_theta
     #distorch = torch.norm(g2*theta)
     out_target = model.predict(x0 + g2*theta)  # should be the target
     timeend = time.time()
     print("\nAdversarial Example Tageted %d Found Successfully: distortion %.4f target %d queries %d alpha %.5f beta %.5f \nTime: %.4f seconds" % (target, g2, out_target, query_count + opt_count, alpha, beta, timeend-timestart))
+    if ray_cache:
+        stats = cache.stats()
+        print("Ray cache answered %d of %d STEP II search queries, %d reached the model" % (stats['saved'], stats['saved'] + stats['queries'], stats['queries']))
     return x0 + g2*theta
 
-def fine_grained_binary_search_local_targeted(model, x0, t, theta, initial_lbd = 1.0):
+def fine_grained_binary_search_local_targeted(model, x0, t, theta, initial_lbd = 1.0, cache = None):
+    predict = (cache or RayProbe(model, x0)).along(theta)
     nquery = 0
     lbd = initial_lbd
    
-    if model.predict(x0+lbd*theta) != t:
+    if predict(lbd) != t:
         lbd_lo = lbd
         lbd_hi = lbd*1.01
         nquery += 1
-        while model.predict(x0+lbd_hi*theta) != t:
+        while predict(lbd_hi) != t:
             lbd_hi = lbd_hi*1.01
             nquery += 1
             if lbd_hi > 100: 
@@ -146,89 +174,30 @@ def fine_grained_binary_search_local_targeted(model, x0, t, theta, initial_lbd =
         lbd_hi = lbd
         lbd_lo = lbd*0.99
         nquery += 1
-        while model.predict(x0+lbd_lo*theta) == t:
+        while predict(lbd_lo) == t:
             lbd_lo = lbd_lo*0.99
             nquery += 1
 
     while (lbd_hi - lbd_lo) > 1e-5:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0 + lbd_mid*theta) == t:
+        if predict(lbd_mid) == t:
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
     return lbd_hi, nquery
 
 def initial_fine_grained_binary_search_targeted(model, x0, target, theta, initial_lbd = 1.0):
-    dim1 = x0.size()[1]
-    dim3 = x0.size()[2]    
-    nquery = 0
-    initial_lbd = torch.ones(theta.size()).cuda()
-    lbd = initial_lbd
-    limit = torch.ones(lbd.size()).cuda()
-    predicted = model.predict_batch(x0+ lbd * theta)
-    nquery += 10
-    candidate = (predicted != target).nonzero().view(-1)
-    while len(candidate.size())>0:
-        lbd[candidate] = lbd[candidate].mul(1.05)
-        nquery += candidate.size()[0]
-        limit.resize_(candidate.size())
-        if torch.max(lbd) > 100: 
-            break
-        predicted = model.predict_batch(x0+ lbd * theta)
-        nquery += candidate.size()[0]
-        candidate = (predicted != target).nonzero().view(-1)
-   
-    #lbd = torch.clamp(lbd,0,100)
-    num_intervals = 100
-    
-    lambdas = torch.randn(lbd.size()[0],num_intervals-1).cuda()
-    for i in range(lbd.size()[0]):
-        lambdas_t = np.linspace(0.0, lbd[i][0][0][0], num_intervals)[1:]
-        lambdas_t = torch.from_numpy(lambdas_t).type(torch.FloatTensor)
-        lambdas[i] = lambdas_t
-    lbd_hi, lbd_hi_index = torch.max(lambdas,1)
-    lbd_lo = lbd_hi.clone()
-
- 
-    for i in range(lbd.size()[0]):
-        temp_lbd = lambdas[i].unsqueeze(1).unsqueeze(2).expand(num_intervals-1,dim1,dim3).unsqueeze(3).expand(num_intervals-1,dim1,dim3,dim3)
-        temp_theta = theta[i].unsqueeze(0).expand(num_intervals-1,dim1,dim3,dim3)
-        temp_x0 = x0[i].unsqueeze(0).expand(num_intervals-1,dim1,dim3,dim3)
-        predicted = model.predict_batch(temp_x0+temp_lbd*temp_theta)
-        candidate = (predicted == target).nonzero().view(-1)
-        nquery += num_intervals-1 - candidate.size()[0]
-        if len(candidate.size())==0:
-            lbd_hi_index[i]=0
-            #print(lbd[i][0],lbd_hi[i])
-            lbd_hi[i] = lbd[i][0][0][0]
-            #return float('inf'), nquery
-        else:
-            lbd_hi_index[i] = torch.min(candidate)
-            lbd_hi[i] = lambdas[i][lbd_hi_index[i]]
-        lbd_lo[i] = lambdas[i][lbd_hi_index[i] - 1]
-
-    while torch.max(lbd_hi - lbd_lo) > 1e-5:
-        lbd_mid = (lbd_lo + lbd_hi)/2.0
-        temp_lbd_mid = lbd_mid.unsqueeze(1).unsqueeze(2).expand(lbd_mid.size()[0],dim1,dim3).unsqueeze(3).expand(lbd_mid.size()[0],dim1,dim3,dim3)
-        predicted = model.predict_batch(x0+temp_lbd_mid*theta)
-        nquery += lbd_mid.size()[0]
-        
-        candidate_y = (predicted == target).nonzero().view(-1)
-        candidate_n = (predicted != target).nonzero().view(-1)
-        if len(candidate_y.size())>0:
-            lbd_hi[candidate_y] = lbd_mid[candidate_y]
-        if len(candidate_n.size())>0:
-            lbd_lo[candidate_n] = lbd_mid[candidate_n]
-    return lbd_hi, nquery
+    probe = RayProbe(model, x0)
+    lbd_lo, lbd_hi, nquery = initial_boundary_scan(model, x0, theta, lambda predicted: predicted == target, probe = probe)
+    return initial_batch_bisection(model, x0, theta, lambda predicted: predicted == target, lbd_lo, lbd_hi, nquery, probe = probe)
 
 def fine_grained_binary_search_targeted(model, x0, target, theta, initial_lbd = 1.0):
     nquery = 0
     lbd = initial_lbd
-    dim1 = x0.size()[0]
-    dim3 = x0.size()[2] 
+    probe = RayProbe(model, x0)
  
-    while model.predict(x0+lbd*theta) != target:
+    while probe.predict(theta, lbd) != target:
         lbd *= 1.05
         nquery +=1
 
@@ -245,14 +214,10 @@ def fine_grained_binary_search_targeted(model, x0, target, theta, initial_lbd =
     #lambdas = torch.from_numpy(lambdas).type(torch.FloatTensor)
     #print(lambdas[98], lbd)
     #print(model.predict(x0+lambdas[98]*theta))
-    temp_lbd = lambdas.unsqueeze(1).unsqueeze(2).expand(num_intervals-1,dim1,dim3).unsqueeze(3).expand(num_intervals-1,dim1,dim3,dim3)
-    #print(temp_lbd[98][0][0][0])
-    temp_theta = theta.expand(num_intervals-1,dim1,dim3,dim3)
-    temp_x0 = x0.expand(num_intervals-1,dim1,dim3,dim3)
-    predicted = model.predict_batch(temp_x0+temp_lbd*temp_theta)
+    predicted = probe.predict_batch(theta, lambdas)
     #print(predicted[98])
     candidate = (predicted == target).nonzero().view(-1)
-    if len(candidate.size())==0:
+    if candidate.numel() == 0:
         lbd_hi_index = 0
         lbd_hi = lbd
         print("aa")
@@ -264,7 +229,7 @@ def fine_grained_binary_search_targeted(model, x0, target, theta, initial_lbd =
     while (lbd_hi - lbd_lo) > 1e-5:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0+lbd_mid*theta) == target:
+        if probe.predict(theta, lbd_mid) == target:
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
@@ -272,17 +237,29 @@ def fine_grained_binary_search_targeted(model, x0, target, theta, initial_lbd =
 
 
 
-def attack_untargeted(model, train_loader, x0, y0, alpha = 0.2, beta = 0.001, iterations = 1000):
+def attack_untargeted(model, train_loader, x0, y0, alpha = 0.2, beta = 0.001, iterations = 1000, prediction_index = None, ray_cache = False, budget = None):
     """ Attack the original image and return adversarial example
         model: (pytorch model)
         train_dataset: set of training data
         (x0, y0): original image
+        prediction_index: PredictionIndex of model on train_loader.dataset; the
+                          candidates are then training images not predicted as y0
+        ray_cache: answer STEP II queries already decided by a known bracket
+                   along the same direction without querying the model; the
+                   directions searched again are an accepted step (temp_theta
+                   is the next iteration's theta), a carried ttt and the final
+                   theta
+        budget: Budget (queries, seconds, distortion plateau) after which the
+                attack stops and returns the best example found so far
     """
 
     if (model.predict(x0) != y0):
         print("Fail to classify the image. No need to attack.")
         return x0
+    if budget is not None:
+        budget.start()
 
+    policy = policy_of(model)
     #num_samples = 100 
     best_theta = None
     best_distortion = float('inf')
@@ -291,28 +268,29 @@ def attack_untargeted(model, train_loader, x0, y0, alpha = 0.2, beta = 0.001, it
     timestart = time.time()
     b_train_size = 1000
     b_best_lbd = float('inf')
-    dim1 = x0.size()[0]
-    dim3 = x0.size()[2]
-    for i, (xi, yi) in enumerate(train_loader):
+    if prediction_index is not None:
+        batches = [prediction_index.load_batch(train_loader.dataset, prediction_index.sample(b_train_size, exclude = y0))]
+    else:
+        batches = train_loader
+    for i, (xi, yi) in enumerate(batches):
         if i == 1:
             break
-        xi,yi=xi.cuda(),yi.cuda()
+        xi, yi = policy.images(xi), policy.tensor(yi)
         temp_x0, temp_y0 = x0, y0
-        predicted = model.predict_batch(xi)
-        b_index = (predicted !=y0).nonzero().squeeze()
-        if len(b_index.size()) == 0:
+        predicted = yi if prediction_index is not None else model.predict_batch(xi)
+        b_index = (predicted !=y0).nonzero().view(-1)
+        if b_index.numel() == 0:
             continue
         xi = xi[b_index]
-        temp_x0 = temp_x0.expand(xi.size()).cuda()
+        temp_x0 = policy.images(temp_x0)
         theta = xi - temp_x0
-        initial_lbd = torch.norm(torch.norm(torch.norm(theta,2,1),2,1),2,1)
-        initial_lbd = initial_lbd.unsqueeze(1).unsqueeze(2).expand(xi.size()[0],dim1,dim3).unsqueeze(3).expand(xi.size()[0],dim1,dim3,dim3)
-        theta /= initial_lbd
+        initial_lbd = theta.view(theta.size(0), -1).norm(2, 1)
+        theta /= initial_lbd.view((-1,) + (1,) * (theta.dim() - 1))
         lbd, query_count = initial_fine_grained_binary_search(model, temp_x0, y0, theta)
         best_lbd, best_index = torch.min(lbd,0)
         best_theta = theta[best_index]
-        if best_lbd[0] < b_best_lbd:
-            b_best_lbd = best_lbd[0]
+        if best_lbd.item() < b_best_lbd:
+            b_best_lbd = best_lbd.item()
             b_best_theta = best_theta.clone()
             print("--------> Found g() %.4f" %b_best_lbd)
 
@@ -326,25 +304,31 @@ def attack_untargeted(model, train_loader, x0, y0, alpha = 0.2, beta = 0.001, it
     theta, g2 = best_theta.clone(), g_theta
     print(model.predict(x0+theta*g2))
     opt_count = 0
+    cache = RayCache(model, x0, lambda label: label != y0) if ray_cache else RayProbe(model, x0)
     torch.manual_seed(0)
     for i in range(iterations):
+        if budget is not None and budget.exhausted(query_count + opt_count, g_theta):
+            print("Stopping at iteration %d: %s" % (i, budget.reason))
+            break
         u = torch.randn(theta.size())
         u = u/torch.norm(u)
-        g2, count = fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = g2)
+        g2, count = fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = g2, cache = cache)
         opt_count += count
+        if g2 < g_theta:
+            best_theta, g_theta = theta.clone(), g2
         ttt = theta+beta * u
         ttt = ttt/torch.norm(ttt)
         ttt = ttt.type(torch.FloatTensor)
-        g1, count = fine_grained_binary_search_local(model, x0, y0, ttt, initial_lbd = g2)
+        g1, count = fine_grained_binary_search_local(model, x0, y0, ttt, initial_lbd = g2, cache = cache)
         opt_count += count
-        temp_output = model.predict(x0+g2*theta)
         if (i+1)%100 == 0:
+            temp_output = cache.along(theta)(g2) if ray_cache else model.predict(x0+g2*theta)
             print("Iteration %3d: g(theta + beta*u) = %.4f g(theta) = %.4f distortion %.4f num_queries %d alpha %.5f beta %.5f output %d" % (i+1, g1, g2, g2, opt_count, alpha, beta, temp_output))
         
         gradient = (g1-g2)/torch.norm(ttt-theta) * u
         temp_theta = theta - alpha*gradient
         temp_theta /= torch.norm(temp_theta)
-        g3, count = fine_grained_binary_search_local(model, x0, y0, temp_theta, initial_lbd = g2)
+        g3, count = fine_grained_binary_search_local(model, x0, y0, temp_theta, initial_lbd = g2, cache = cache)
         if g3 > g1:
             #print("aa")
             theta = ttt
@@ -354,102 +338,147 @@ def attack_untargeted(model, train_loader, x0, y0, alpha = 0.2, beta = 0.001, it
             theta /= torch.norm(theta)
 
    
-    g2, count = fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = g2)
+    g2, count = fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = g2, cache = cache)
+    if g2 > g_theta:
+        theta, g2 = best_theta, g_theta
     out_target = model.predict(x0 + g2*theta)  # should be the target
     timeend = time.time()
     print("\nAdversarial Example Found Successfully: distortion %.4f target %d queries %d alpha %.5f beta %.5f \nTime: %.4f seconds" % (g2, out_target, query_count + opt_count, alpha, beta, timeend-timestart))
+    if ray_cache:
+        stats = cache.stats()
+        print("Ray cache answered %d of %d STEP II search queries, %d reached the model" % (stats['saved'], stats['saved'] + stats['queries'], stats['queries']))
     return x0 + g2*theta
 
-def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = 1.0):
+def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = 1.0, cache = None):
+    predict = (cache or RayProbe(model, x0)).along(theta)
     nquery = 0
     lbd = initial_lbd
-    if model.predict(x0+lbd*theta) == y0:
+    if predict(lbd) == y0:
         lbd_lo = lbd
         lbd_hi = lbd*1.01
         nquery += 1
-        while model.predict(x0+lbd_hi*theta) == y0:
+        while predict(lbd_hi) == y0:
             lbd_hi = lbd_hi*1.01
             nquery += 1
     else:
         lbd_hi = lbd
         lbd_lo = lbd*0.99
         nquery += 1
-        while model.predict(x0+lbd_lo*theta) != y0 :
+        while predict(lbd_lo) != y0 :
             lbd_lo = lbd_lo*0.99
             nquery += 1
     while (lbd_hi - lbd_lo) > 1e-5:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0 + lbd_mid*theta) != y0:
+        if predict(lbd_mid) != y0:
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
     return lbd_hi, nquery
 
 def initial_fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0):
-    dim1 = x0.size()[1]
-    dim3 = x0.size()[2] 
+    probe = RayProbe(model, x0)
+    lbd_lo, lbd_hi, nquery = initial_boundary_scan(model, x0, theta, lambda predicted: predicted != y0, probe = probe)
+    return initial_batch_bisection(model, x0, theta, lambda predicted: predicted != y0, lbd_lo, lbd_hi, nquery, probe = probe)
+
+def initial_boundary_scan(model, x0, theta, is_adv, num_intervals = 100, chunk_size = 1000, max_lbd = 100, probe = None):
+    """ STEP I coarse search over all candidate directions as batched tensor ops
+        x0, theta: original image and (N, C, H, W) unit directions
+        is_adv: maps a tensor of predicted labels to a mask
+        probe: RayProbe of x0 whose batch buffer holds the queried images
+        output: lbd_lo, lbd_hi (N,) bracketing the first boundary crossing, nquery
+        A direction whose grid is benign up to the smallest adversarial lbd
+        found so far cannot give the minimum; its scan stops there and its
+        bracket is (inf, inf).
+    """
+    n = theta.size()[0]
+    probe = probe or RayProbe(model, x0)
     nquery = 0
-    initial_lbd = torch.ones(theta.size()).cuda()
-    lbd = initial_lbd
-    limit = torch.ones(lbd.size()).cuda()
-    predicted = model.predict_batch(x0+ lbd * theta)
-    nquery += 10
-    candidate = (predicted == y0).nonzero().view(-1)
-    while len(candidate.size())>0:
+
+    # grow lbd by 1.05 until each direction is adversarial or passes max_lbd
+    lbd = theta.new(n).fill_(1.0)
+    predicted = probe.predict_batch(theta, lbd)
+    nquery += n
+    candidate = (is_adv(predicted) == 0).nonzero().view(-1)
+    while candidate.numel() > 0:
         lbd[candidate] = lbd[candidate].mul(1.05)
-        limit.resize_(candidate.size())
-        if torch.max(lbd) > 100: 
+        if torch.max(lbd) > max_lbd:
             break
-        predicted = model.predict_batch(x0+ lbd * theta)
-        nquery += candidate.size()[0]
-        candidate = (predicted == y0).nonzero().view(-1)
-    num_intervals = 100
-    
-    lambdas = torch.randn(lbd.size()[0],num_intervals-1).cuda()
-    for i in range(lbd.size()[0]):
-        lambdas_t = np.linspace(0.0, lbd[i][0][0][0], num_intervals)[1:]
-        lambdas_t = torch.from_numpy(lambdas_t).type(torch.FloatTensor)
-        lambdas[i] = lambdas_t
-    lbd_hi, lbd_hi_index = torch.max(lambdas,1)
-    lbd_lo = lbd_hi.clone()
-    for i in range(lbd.size()[0]):
-        temp_lbd = lambdas[i].unsqueeze(1).unsqueeze(2).expand(num_intervals-1,dim1,dim3).unsqueeze(3).expand(num_intervals-1,dim1,dim3,dim3)
-        temp_theta = theta[i].unsqueeze(0).expand(num_intervals-1,dim1,dim3,dim3)
-        temp_x0 = x0[i].unsqueeze(0).expand(num_intervals-1,dim1,dim3,dim3)
-        predicted = model.predict_batch(temp_x0+temp_lbd*temp_theta)
-        candidate = (predicted!=y0).nonzero().view(-1)
-        nquery += num_intervals-1 - candidate.size()[0]
-        if len(candidate.size())==0:
-            lbd_hi_index[i] = 0
-            #print(lbd[i][0],lbd_hi[i])
-            lbd_hi[i] = lbd[i][0][0][0]
-            #return float('inf'), nquery
-        else:
-            lbd_hi_index[i] = torch.min(candidate)
-            lbd_hi[i] = lambdas[i][lbd_hi_index[i]]
-        lbd_lo[i] = lambdas[i][lbd_hi_index[i] - 1]
-
-    while torch.max(lbd_hi - lbd_lo) > 1e-5:
-        lbd_mid = (lbd_lo + lbd_hi)/2.0
-        temp_lbd_mid = lbd_mid.unsqueeze(1).unsqueeze(2).expand(lbd_mid.size()[0],dim1,dim3).unsqueeze(3).expand(lbd_mid.size()[0],dim1,dim3,dim3)
-        predicted = model.predict_batch(x0+temp_lbd_mid*theta)
-        nquery += lbd_mid.size()[0]
-        
-        candidate_y = (predicted!=y0).nonzero().view(-1)
-        candidate_n = (predicted==y0).nonzero().view(-1)
-        if len(candidate_y.size())>0:
-            lbd_hi[candidate_y] = lbd_mid[candidate_y]
-        if len(candidate_n.size())>0:
-            lbd_lo[candidate_n] = lbd_mid[candidate_n]
+        predicted = probe.predict_batch(theta, lbd[candidate], candidate)
+        nquery += candidate.numel()
+        candidate = candidate[(is_adv(predicted) == 0).nonzero().view(-1)]
+
+    # grid of num_intervals-1 points in (0, lbd] per direction
+    m = num_intervals - 1
+    lambdas = lbd.view(-1, 1) * torch.linspace(0.0, 1.0, num_intervals)[1:].type_as(lbd).view(1, -1)
+    first = lbd.new(n).long().fill_(m)
+
+    # the smallest lbd known to be adversarial bounds the minimum from above
+    reached = lbd.new(n).fill_(1)
+    reached[candidate] = 0
+    best = lbd[reached > 0].min().item() if reached.sum() > 0 else float('inf')
+    pruned = first.new(n).zero_()
+
+    # scan the grid in chunks of at most chunk_size images, dropping a
+    # direction as soon as its first crossing is found or its grid passes best
+    scanning = torch.arange(0, n).type_as(first)
+    start = 0
+    while scanning.numel() > 0 and start < m:
+        block = max(1, min(m - start, chunk_size // scanning.numel()))
+        rows = max(1, chunk_size // block)
+        found = []
+        for r in range(0, scanning.numel(), rows):
+            index = scanning[r:r+rows]
+            lam = lambdas[index, start:start+block].contiguous().view(-1)
+            directions = index.view(-1, 1).expand(index.numel(), block).contiguous().view(-1)
+            adv = is_adv(probe.predict_batch(theta, lam, directions)).view(index.numel(), block).long()
+            nquery += index.numel() * block
+            # weight earlier grid points higher so the max picks the first crossing
+            weight = torch.arange(block, 0, -1).type_as(adv).view(1, -1)
+            hit, offset = torch.max(adv * weight, 1)
+            hit = hit > 0
+            first[index[hit]] = start + offset[hit]
+            if hit.any():
+                best = min(best, lambdas[index[hit], start + offset[hit]].min().item())
+            found.append(hit)
+        scanning = scanning[(torch.cat(found) == 0).nonzero().view(-1)]
+        start += block
+        beyond = lambdas[scanning, start - 1] >= best
+        pruned[scanning[beyond]] = 1
+        scanning = scanning[(beyond == 0).nonzero().view(-1)]
+
+    crossed = first < m
+    index = torch.clamp(first, max = m - 1).view(-1, 1)
+    lbd_hi = torch.where(crossed, lambdas.gather(1, index).view(-1), lbd)
+    lbd_lo = torch.where(first > 0, lambdas.gather(1, torch.clamp(index - 1, min = 0)).view(-1), torch.zeros_like(lbd))
+    lbd_lo = torch.where(crossed, lbd_lo, lbd)
+    lbd_lo[pruned > 0] = float('inf')
+    lbd_hi[pruned > 0] = float('inf')
+    return lbd_lo, lbd_hi, nquery
+
+def initial_batch_bisection(model, x0, theta, is_adv, lbd_lo, lbd_hi, nquery, tol = 1e-5, probe = None):
+    """ Bisect every (lbd_lo, lbd_hi) bracket from initial_boundary_scan to tol.
+        A bracket whose lbd_lo is at or above the smallest lbd_hi cannot hold
+        the minimum and is left as it is.
+    """
+    probe = probe or RayProbe(model, x0)
+    def unresolved():
+        return (((lbd_hi - lbd_lo) > tol) & (lbd_lo < torch.min(lbd_hi))).nonzero().view(-1)
+    active = unresolved()
+    while active.numel() > 0:
+        lbd_mid = (lbd_lo[active] + lbd_hi[active])/2.0
+        adv = is_adv(probe.predict_batch(theta, lbd_mid, active))
+        nquery += active.numel()
+        lbd_hi[active] = torch.where(adv, lbd_mid, lbd_hi[active])
+        lbd_lo[active] = torch.where(adv, lbd_lo[active], lbd_mid)
+        active = unresolved()
     return lbd_hi, nquery
 
 def fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0):
     nquery = 0
     lbd = initial_lbd
-    dim1 = x0.size()[0]
-    dim3 = x0.size()[2]
-    while model.predict(x0+lbd*theta) == y0:
+    probe = RayProbe(model, x0)
+    while probe.predict(theta, lbd) == y0:
         lbd *= 1.05
         nquery +=1
 
@@ -466,14 +495,10 @@ def fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0):
     #lambdas = torch.from_numpy(lambdas).type(torch.FloatTensor)
     #print(lambdas[98], lbd)
     #print(model.predict(x0+lambdas[98]*theta))
-    temp_lbd = lambdas.unsqueeze(1).unsqueeze(2).expand(num_intervals-1,dim1,dim3).unsqueeze(3).expand(num_intervals-1,dim1,dim3,dim3)
-    #print(temp_lbd[98][0][0][0])
-    temp_theta = theta.expand(num_intervals-1,dim1,dim3,dim3)
-    temp_x0 = x0.expand(num_intervals-1,dim1,dim3,dim3)
-    predicted = model.predict_batch(temp_x0+temp_lbd*temp_theta)
+    predicted = probe.predict_batch(theta, lambdas)
     #print(predicted[98])
     candidate = (predicted!=y0).nonzero().view(-1)
-    if len(candidate.size())==0:
+    if candidate.numel() == 0:
         lbd_hi_index = 0
         lbd_hi = lbd
         print("aa")
@@ -485,59 +510,61 @@ def fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0):
     while (lbd_hi - lbd_lo) > 1e-5:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0+lbd_mid*theta) !=y0:
+        if probe.predict(theta, lbd_mid) !=y0:
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
     return lbd_hi, nquery
 
 
-def attack_single(model, train_loader, image, label, target = None, alpha=0.2):
+def attack_single(model, train_loader, image, label, target = None, alpha=0.2, prediction_index=None, budget=None):
     #show_image(image.numpy())
     print("Original label: ", label)
     print("Predicted label: ", model.predict(image))
     if target == None:
-        adversarial = attack_untargeted(model, train_loader, image, label, alpha = alpha, beta = beta, iterations = 5000)
+        adversarial = attack_untargeted(model, train_loader, image, label, alpha = alpha, beta = beta, iterations = 5000, prediction_index = prediction_index, budget = budget)
     else:
         print("Targeted attack: %d" % target)
-        adversarial = attack_targeted(model, train_loader, image, label, target, alpha = alpha, beta = beta, iterations = 5000)
+        adversarial = attack_targeted(model, train_loader, image, label, target, alpha = alpha, beta = beta, iterations = 5000, prediction_index = prediction_index, budget = budget)
     show_image(adversarial.numpy())
     print("Predicted label for adversarial example: ", model.predict(adversarial))
     return torch.norm(adversarial - image)
 
-def attack_mnist(alpha):
+def attack_mnist(alpha, use_index=False, device=None, num_threads=None, budget=None, prefetch_depth=2):
     train_loader, test_loader, train_dataset, test_dataset = load_mnist_data()
+    policy = DevicePolicy(device, num_threads=num_threads)
     net = MNIST()
     #train_loader, test_loader, train_dataset, test_dataset = load_cifar10_data()
     #net = CIFAR10()
-    if torch.cuda.is_available():
-        net.cuda()
-        net = torch.nn.DataParallel(net, device_ids=[0])
-        #net = torch.nn.DataParallel(net, device_ids=range(torch.cuda.device_count()))
+    net = policy.module(net)
         
     load_model(net, 'models/mnist_gpu.pt')
     #load_model(net, 'models/cifar10.pt')
     net.eval()
 
-    model = net.module if torch.cuda.is_available() else net
+    model = unwrap(net)
+    model.policy = policy
+    index = load_prediction_index(model, train_dataset, 'mnist', 'models/mnist_gpu.pt') if use_index else None
 
     num_images = 10
     
     print("\n\n\n\n\n Running on {} random images \n\n\n".format(num_images))
     distortion_random_sample = 0.0
 
-    random.seed(0)
-    for _ in range(num_images):
-        idx = random.randint(100, len(test_dataset)-1)
-        #idx = 3743
-        image, label = test_dataset[idx]
-        print("\n\n\n\n======== Image %d =========" % idx)
+    rng = random.Random(0)
+    def choose_target(idx, label):
         targets = list(range(10))
         targets.pop(label)
-        target = random.choice(targets)
+        target = rng.choice(targets)
         #target = 4
         #target = None   #--> uncomment of untarget
-        distortion_random_sample += attack_single(model, train_loader, image, label, target, alpha)
+        return target
+    indices = (rng.randint(100, len(test_dataset)-1) for _ in range(num_images))
+    for job in prefetch(attack_jobs(test_dataset, indices, choose_target, place=policy.pin), prefetch_depth):
+        idx, image, label, target = job['index'], job['image'], job['label'], job['target']
+        #idx = 3743
+        print("\n\n\n\n======== Image %d =========" % idx)
+        distortion_random_sample += attack_single(model, train_loader, image, label, target, alpha, index, budget)
 
     #print("\n\n\n\n\n Running on first {} images \n\n\n".format(num_images))
     print("Average distortion on random {} images is {}".format(num_images, distortion_random_sample/num_images))
@@ -554,39 +581,41 @@ def attack_mnist(alpha):
     print("\n\nAverage distortion on first {} images is {}".format(num_images, distortion_fix_sample/num_images))
     print("Average distortion on random {} images is {}".format(num_images, distortion_random_sample/num_images))
     '''
-def attack_cifar(alpha):
+def attack_cifar(alpha, use_index=False, device=None, num_threads=None, budget=None, prefetch_depth=2):
     #train_loader, test_loader, train_dataset, test_dataset = load_mnist_data()
     #net = MNIST()
     train_loader, test_loader, train_dataset, test_dataset = load_cifar10_data()
+    policy = DevicePolicy(device, num_threads=num_threads)
     net = CIFAR10()
-    if torch.cuda.is_available():
-        net.cuda()
-        net = torch.nn.DataParallel(net, device_ids=[0])
-        #net = torch.nn.DataParallel(net, device_ids=range(torch.cuda.device_count()))
+    net = policy.module(net)
         
     #load_model(net, 'models/mnist_gpu.pt')
     load_model(net, 'models/cifar10_gpu.pt')
     net.eval()
 
-    model = net.module if torch.cuda.is_available() else net
+    model = unwrap(net)
+    model.policy = policy
+    index = load_prediction_index(model, train_dataset, 'cifar10', 'models/cifar10_gpu.pt') if use_index else None
 
     num_images = 10
     
     print("\n\n\n\n\n Running on {} random images \n\n\n".format(num_images))
     distortion_random_sample = 0.0
 
-    random.seed(0)
-    for _ in range(num_images):
-        idx = random.randint(100, len(test_dataset)-1)
-        #idx = 5474
-        image, label = test_dataset[idx]
-        print("\n\n\n\n======== Image %d =========" % idx)
+    rng = random.Random(0)
+    def choose_target(idx, label):
         targets = list(range(10))
         targets.pop(label)
-        target = random.choice(targets)
+        target = rng.choice(targets)
         #target = 3
         target = None   #--> uncomment of untarget
-        distortion_random_sample += attack_single(model, train_loader, image, label, target, alpha)
+        return target
+    indices = (rng.randint(100, len(test_dataset)-1) for _ in range(num_images))
+    for job in prefetch(attack_jobs(test_dataset, indices, choose_target, place=policy.pin), prefetch_depth):
+        idx, image, label, target = job['index'], job['image'], job['label'], job['target']
+        #idx = 5474
+        print("\n\n\n\n======== Image %d =========" % idx)
+        distortion_random_sample += attack_single(model, train_loader, image, label, target, alpha, index, budget)
 
     #print("\n\n\n\n\n Running on first {} images \n\n\n".format(num_images))
     print("Average distortion on random {} images is {}".format(num_images, distortion_random_sample/num_images))
@@ -603,13 +632,14 @@ def attack_cifar(alpha):
     print("\n\nAverage distortion on first {} images is {}".format(num_images, distortion_fix_sample/num_images))
     print("Average distortion on random {} images is {}".format(num_images, distortion_random_sample/num_images))
     '''
-def attack_imgnet():
+def attack_imgnet(use_index=False, device=None, num_threads=None, budget=None, prefetch_depth=2):
     '''
     model_name = 'inceptionresnetv2' # could be fbresnet152 or inceptionresnetv2
     model = pretrainedmodels.__dict__[model_name](num_classes=1000, pretrained='imagenet')
     '''
     #model = torchvision.models.vgg19(pretrained=True)
-    model = IMAGENET('vgg19')
+    policy = DevicePolicy(device, num_threads=num_threads)
+    model = IMAGENET('vgg19', policy)
     
     #model = model.module if torch.cuda.is_available() else net
     '''
@@ -642,20 +672,23 @@ def attack_imgnet():
     #    print(output)
     '''
     test_loader, test_dataset = imagenettest()
+    index = load_prediction_index(model, test_dataset, 'imagenet-test-vgg19', model.checkpoint) if use_index else None
     distortion_random_sample = 0
     num_images = 10
-    random.seed(0)
-    for _ in range(num_images):
-        idx = random.randint(100, len(test_dataset)-1)
-        #idx = 3743
-        image, label = test_dataset[idx]
-        print("\n\n\n\n======== Image %d =========" % idx)
+    rng = random.Random(0)
+    def choose_target(idx, label):
         targets = list(range(1000))
         targets.pop(label)
-        target = random.choice(targets)
+        target = rng.choice(targets)
         #target = 4
         target = None   #--> uncomment of untarget
-        distortion_random_sample += attack_single(model, test_loader, image, label, target, 0.2)
+        return target
+    indices = (rng.randint(100, len(test_dataset)-1) for _ in range(num_images))
+    for job in prefetch(attack_jobs(test_dataset, indices, choose_target, place=policy.pin), prefetch_depth):
+        idx, image, label, target = job['index'], job['image'], job['label'], job['target']
+        #idx = 3743
+        print("\n\n\n\n======== Image %d =========" % idx)
+        distortion_random_sample += attack_single(model, test_loader, image, label, target, 0.2, index, budget)
 
     #print("\n\n\n\n\n Running on first {} images \n\n\n".format(num_images))
     print("Average distortion on random {} images is {}".format(num_images, distortion_random_sample/num_images))
@@ -1,3 +1,4 @@
+import os
 import time
 import random 
 import numpy as np
@@ -7,66 +8,204 @@ import torchvision.datasets as dsets
 import torchvision.transforms as transforms
 from torch.autograd import Variable
 import torch.nn.functional as F
-from models import IMAGENET, MNIST, CIFAR10, load_imagenet_data, load_mnist_data, load_cifar10_data, load_model, show_image
+import boundary_search
+from prediction_index import load_prediction_index
+from oracle import load_decision_cache, predict_points, RayProbe
+from subspace import make_subspace
+from checkpoint import save_checkpoint, load_checkpoint, clear_checkpoint, set_rng_state, RunProgress
+from pipeline import attack_jobs, prefetch, choose_target
+from models import IMAGENET, MNIST, CIFAR10, DevicePolicy, unwrap, load_imagenet_data, load_mnist_data, load_cifar10_data, load_model, show_image
+
+
+# The attacks and their searches are generators: every batch of images they
+# need classified is yielded (built by the attack's RayProbe, so already within
+# the model's bounds) and the predicted labels are sent back. run answers them
+# with the model one batch at a time; lockstep_attack.run_lockstep advances
+# many attacks together and answers all their batches at once.
+
+def ask(image):
+    """ Label of one image, asked as a batch of one """
+    labels = yield image.unsqueeze(0)
+    return labels[0]
+
+def run(model, steps):
+    """ Drive a search or attack generator synchronously: every batch of images
+        it yields is answered with one predict_batch of model
+    """
+    try:
+        images = next(steps)
+        while True:
+            images = steps.send(predict_points(model, images))
+    except StopIteration as e:
+        return e.value
+
 
+def attack_targeted(model, *args, **kwargs):
+    """ attack_targeted_steps(model, ...) run synchronously on model """
+    return run(model, attack_targeted_steps(model, *args, **kwargs))
 
-def attack_targeted(model, train_dataset, x0, y0, target, alpha = 0.1, beta = 0.001, iterations = 1000):
+def attack_targeted_steps(model, train_dataset, x0, y0, target, alpha = 0.1, beta = 0.001, iterations = 1000, batch_directions = False, parallel_line_search = False, search_k = 1, prediction_index = None, neighbor_index = None, num_neighbors = 20, subspace = None, checkpoint = None, checkpoint_every = 50, budget = None, candidates = None, seed = None):
     """ Attack the original image and return adversarial example of target t
         model: (pytorch model)
         train_dataset: set of training data
         (x0, y0): original image
         t: target
+        batch_directions: search the q random directions together with predict_batch
+        parallel_line_search: resolve all step sizes of the line search together
+        search_k: points per round of the boundary searches (1 is bisection,
+                  'auto' picks it from the model's batch cost curve)
+        prediction_index: PredictionIndex of model on train_dataset; STEP I then
+                          samples only training images of a suitable class
+        neighbor_index: NeighborIndex over train_dataset; STEP I then only tries
+                        the num_neighbors closest training images of a suitable class
+        subspace: LowResolution or LowFrequency subspace the STEP II random
+                  directions are drawn in (full pixel space if None)
+        checkpoint: file the STEP II state is saved to every checkpoint_every
+                    iterations; if it exists the attack resumes from it
+        budget: Budget (queries, seconds, distortion plateau) after which the
+                attack stops and returns the best example found so far
+        candidates: (training indices, their images or None) STEP I tries,
+                    prefetched by pipeline.attack_jobs; drawn here if None
+        seed: draw the STEP I samples and STEP II directions from generators
+              seeded with seed, so that the attack does not depend on the
+              attacks it is interleaved with (global RNGs if None)
     """
 
-    if (model.predict(x0) != y0):
+    probe = RayProbe(model, x0)
+    if (yield from ask(probe.image(x0))) != y0:
         print("Fail to classify the image. No need to attack.")
         return x0
+    if budget is not None:
+        budget.start()
+    if search_k == 'auto':
+        search_k = boundary_search.choose_k(model, x0)
+        print("Using %d-ary boundary search" % search_k)
+    sampler, rng = seeded(seed)
+    is_adv = lambda predicted: predicted == target
 
     # STEP I: find initial direction (theta, g_theta)
 
-    num_samples = 100
-    best_theta, g_theta = None, float('inf')
-    query_count = 0
-
-    print("Searching for the initial direction on %d samples: " % (num_samples))
-    timestart = time.time()
-    samples = set(random.sample(range(len(train_dataset)), num_samples))
-    for i, (xi, yi) in enumerate(train_dataset):
-        if i not in samples:
-            continue
-        query_count += 1
-        if model.predict(xi) == target:
+    state = load_checkpoint(checkpoint)
+    if state is not None:
+        best_theta, g_theta, query_count = state['best_theta'], state['g_theta'], state['query_count']
+    else:
+        num_samples = 100
+        best_theta, g_theta = None, float('inf')
+        query_count = 0
+
+        if neighbor_index is not None:
+            num_samples = num_neighbors
+        print("Searching for the initial direction on %d samples: " % (num_samples))
+        timestart = time.time()
+        images = None
+        if candidates is not None:
+            samples, images = candidates
+        elif neighbor_index is not None:
+            samples, _ = neighbor_index.search(x0, num_neighbors, label = target)
+        elif prediction_index is not None:
+            samples = prediction_index.sample(num_samples, label = target, rng = sampler)
+        else:
+            samples = sorted(sampler.sample(range(len(train_dataset)), num_samples))
+        checked = prediction_index is not None if neighbor_index is None else neighbor_index.predicted
+        for n, i in enumerate(samples):
+            if budget is not None and best_theta is not None and (budget.reached(g_theta) or budget.exhausted(query_count)):
+                break
+            xi = images[n] if images is not None else train_dataset[i][0]
+            if not checked:
+                query_count += 1
+                if (yield from ask(probe.image(xi))) != target:
+                    continue
             theta = xi - x0
-            initial_lbd = torch.norm(theta)
+            initial_lbd = torch.norm(theta).item()
             theta = theta/torch.norm(theta)
-            lbd, count = fine_grained_binary_search_targeted(model, x0, y0, target, theta, initial_lbd)
+            lbd, count = yield from initial_search_targeted_steps(probe, theta, is_adv, initial_lbd, k = search_k)
             query_count += count
             if lbd < g_theta:
                 best_theta, g_theta = theta, lbd
                 print("--------> Found distortion %.4f" % g_theta)
 
-    timeend = time.time()
-    print("==========> Found best distortion %.4f in %.4f seconds using %d queries" % (g_theta, timeend-timestart, query_count))
+        timeend = time.time()
+        print("==========> Found best distortion %.4f in %.4f seconds using %d queries" % (g_theta, timeend-timestart, query_count))
+        if best_theta is None:
+            print("Couldn't find a valid initial direction, failed")
+            return x0
 
 
     # STEP II: seach for optimal
     timestart = time.time()
+    best_theta, g_theta, opt_count, unused_count = yield from optimize_steps(probe, best_theta, g_theta, is_adv, 100, alpha, beta, iterations, query_count,
+            batch_directions, parallel_line_search, search_k, subspace, checkpoint = checkpoint, checkpoint_every = checkpoint_every, budget = budget, state = state, rng = rng)
 
+    clear_checkpoint(checkpoint)
+    predicted = yield from ask(probe.point(best_theta, g_theta))
+    timeend = time.time()
+    print("\nAdversarial Example Found Successfully: distortion %.4f target %d queries %d \nTime: %.4f seconds" % (g_theta, predicted, query_count + opt_count, timeend-timestart))
+    if parallel_line_search:
+        print("Parallel line search spent %d queries on steps whose result the serial search did not use" % unused_count)
+    return x0 + g_theta*best_theta
+
+def seeded(seed):
+    """ (sampler, torch.Generator) seeded with seed, or the global random
+        module and None (the global torch RNG) if seed is None
+    """
+    if seed is None:
+        return random, None
+    rng = torch.Generator()
+    rng.manual_seed(seed)
+    return random.Random(seed), rng
+
+def optimize_steps(probe, best_theta, g_theta, is_adv, max_lbd, alpha, beta, iterations, query_count = 0, batch_directions = False, parallel_line_search = False, search_k = 1, subspace = None, stopping = None, checkpoint = None, checkpoint_every = 50, budget = None, state = None, rng = None):
+    """ STEP II of attack_untargeted and attack_targeted from the direction
+        (best_theta, g_theta) found by STEP I
+        max_lbd: the boundary searches give up above it
+        query_count: queries spent by STEP I, counted by the budget and saved
+        stopping: stop once g2 drops by less than stopping in 50 iterations
+        state: checkpoint to resume from
+        rng: torch.Generator of the random directions (global RNG if None)
+        output: best_theta, g_theta, queries spent and the queries spent by
+                parallel_line_search on steps whose result was not used
+    """
     g1 = 1.0
     theta, g2 = best_theta.clone(), g_theta
     opt_count = 0
-
-    for i in range(iterations):
+    unused_count = 0
+    prev_obj = 100000
+    start = 0
+    if state is not None:
+        start = state['iteration']
+        theta, g2, alpha, beta = state['theta'], state['g2'], state['alpha'], state['beta']
+        opt_count, unused_count = state['opt_count'], state['unused_count']
+        prev_obj = state.get('prev_obj', prev_obj)
+        set_rng_state(state['rng'])
+        if rng is not None:
+            rng.set_state(state['generator'])
+        print("Resuming from iteration %d: distortion %.4f queries %d" % (start, g_theta, query_count + opt_count))
+
+    for i in range(start, iterations):
+        if budget is not None and budget.exhausted(query_count + opt_count, g_theta):
+            print("Stopping at iteration %d: %s" % (i, budget.reason))
+            break
         gradient = torch.zeros(theta.size())
         q = 10
         min_g1 = float('inf')
+        us, ttts = [], []
         for _ in range(q):
-            u = torch.randn(theta.size()).type(torch.FloatTensor)
+            u = subspace.sample(i, rng) if subspace is not None else torch.randn(theta.size(), generator = rng).type(torch.FloatTensor)
             u = u/torch.norm(u)
             ttt = theta+beta * u
             ttt = ttt/torch.norm(ttt)
-            g1, count = fine_grained_binary_search_local_targeted(model, x0, y0, target, ttt, initial_lbd = g2, tol=beta/500)
-            opt_count += count
+            us.append(u)
+            ttts.append(ttt)
+        if batch_directions:
+            g1s, counts = yield from batch_local_search_steps(probe, torch.stack(ttts), is_adv, initial_lbd = g2, tol=beta/500, max_lbd = max_lbd)
+            opt_count += sum(counts)
+        else:
+            g1s = []
+            for ttt in ttts:
+                g1, count = yield from local_search_steps(probe, ttt, is_adv, initial_lbd = g2, tol=beta/500, max_lbd = max_lbd, k = search_k)
+                opt_count += count
+                g1s.append(g1)
+        for u, ttt, g1 in zip(us, ttts, g1s):
             gradient += (g1-g2)/beta * u
             if g1 < min_g1:
                 min_g1 = g1
@@ -75,34 +214,43 @@ def attack_targeted(model, train_dataset, x0, y0, target, alpha = 0.1, beta = 0.
 
         if (i+1)%50 == 0:
             print("Iteration %3d: g(theta + beta*u) = %.4f g(theta) = %.4f distortion %.4f num_queries %d" % (i+1, g1, g2, torch.norm(g2*theta), opt_count))
+            if stopping is not None:
+                if g2 > prev_obj-stopping:
+                    break
+                prev_obj = g2
 
         min_theta = theta
         min_g2 = g2
-    
-        for _ in range(15):
-            new_theta = theta - alpha * gradient
-            new_theta = new_theta/torch.norm(new_theta)
-            new_g2, count = fine_grained_binary_search_local_targeted(model, x0, y0, target, new_theta, initial_lbd = min_g2, tol=beta/500)
-            opt_count += count
-            alpha = alpha * 2
-            if new_g2 < min_g2:
-                min_theta = new_theta 
-                min_g2 = new_g2
-            else:
-                break
 
-        if min_g2 >= g2:
+        if parallel_line_search:
+            min_theta, min_g2, alpha, count, unused = yield from batch_line_search_steps(probe, theta, gradient, alpha, g2, is_adv, tol=beta/500, max_lbd = max_lbd)
+            opt_count += count
+            unused_count += unused
+        else:
             for _ in range(15):
-                alpha = alpha * 0.25
                 new_theta = theta - alpha * gradient
                 new_theta = new_theta/torch.norm(new_theta)
-                new_g2, count = fine_grained_binary_search_local_targeted(model, x0, y0, target, new_theta, initial_lbd = min_g2, tol=beta/500)
+                new_g2, count = yield from local_search_steps(probe, new_theta, is_adv, initial_lbd = min_g2, tol=beta/500, max_lbd = max_lbd, k = search_k)
                 opt_count += count
-                if new_g2 < g2:
-                    min_theta = new_theta 
+                alpha = alpha * 2
+                if new_g2 < min_g2:
+                    min_theta = new_theta
                     min_g2 = new_g2
+                else:
                     break
 
+            if min_g2 >= g2:
+                for _ in range(15):
+                    alpha = alpha * 0.25
+                    new_theta = theta - alpha * gradient
+                    new_theta = new_theta/torch.norm(new_theta)
+                    new_g2, count = yield from local_search_steps(probe, new_theta, is_adv, initial_lbd = min_g2, tol=beta/500, max_lbd = max_lbd, k = search_k)
+                    opt_count += count
+                    if new_g2 < g2:
+                        min_theta = new_theta
+                        min_g2 = new_g2
+                        break
+
         if min_g2 <= min_g1:
             theta, g2 = min_theta, min_g2
         else:
@@ -110,7 +258,7 @@ def attack_targeted(model, train_dataset, x0, y0, target, alpha = 0.1, beta = 0.
 
         if g2 < g_theta:
             best_theta, g_theta = theta.clone(), g2
-        
+
         #print(alpha)
         if alpha < 1e-4:
             alpha = 1.0
@@ -119,49 +267,36 @@ def attack_targeted(model, train_dataset, x0, y0, target, alpha = 0.1, beta = 0.
             if (beta < 0.0005):
                 break
 
-    target = model.predict(x0 + g_theta*best_theta)
-    timeend = time.time()
-    print("\nAdversarial Example Found Successfully: distortion %.4f target %d queries %d \nTime: %.4f seconds" % (g_theta, target, query_count + opt_count, timeend-timestart))
-    return x0 + g_theta*best_theta
+        if checkpoint is not None and (i+1)%checkpoint_every == 0:
+            saved = {'iteration': i+1, 'theta': theta, 'g2': g2, 'best_theta': best_theta, 'g_theta': g_theta,
+                     'alpha': alpha, 'beta': beta, 'query_count': query_count, 'opt_count': opt_count,
+                     'unused_count': unused_count, 'prev_obj': prev_obj}
+            if rng is not None:
+                saved['generator'] = rng.get_state()
+            save_checkpoint(checkpoint, saved)
 
-def fine_grained_binary_search_local_targeted(model, x0, y0, t, theta, initial_lbd = 1.0, tol=1e-5):
-    nquery = 0
-    lbd = initial_lbd
-   
-    if model.predict(x0+lbd*theta) != t:
-        lbd_lo = lbd
-        lbd_hi = lbd*1.01
-        nquery += 1
-        while model.predict(x0+lbd_hi*theta) != t:
-            lbd_hi = lbd_hi*1.01
-            nquery += 1
-            if lbd_hi > 100: 
-                return float('inf'), nquery
-    else:
-        lbd_hi = lbd
-        lbd_lo = lbd*0.99
-        nquery += 1
-        while model.predict(x0+lbd_lo*theta) == t:
-            lbd_lo = lbd_lo*0.99
-            nquery += 1
+    return best_theta, g_theta, opt_count, unused_count
 
-    while (lbd_hi - lbd_lo) > tol:
-        lbd_mid = (lbd_lo + lbd_hi)/2.0
-        nquery += 1
-        if model.predict(x0 + lbd_mid*theta) == t:
-            lbd_hi = lbd_mid
-        else:
-            lbd_lo = lbd_mid
-    return lbd_hi, nquery
+def fine_grained_binary_search_local_targeted(model, x0, y0, t, theta, initial_lbd = 1.0, tol=1e-5, k = 1, probe = None):
+    return run(model, local_search_steps(probe or RayProbe(model, x0), theta, lambda predicted: predicted == t, initial_lbd, tol, 100, k))
+
+def fine_grained_binary_search_targeted(model, x0, y0, t, theta, initial_lbd = 1.0, k = 1, probe = None):
+    return run(model, initial_search_targeted_steps(probe or RayProbe(model, x0), theta, lambda predicted: predicted == t, initial_lbd, k))
 
-def fine_grained_binary_search_targeted(model, x0, y0, t, theta, initial_lbd = 1.0):
+def initial_search_targeted_steps(probe, theta, is_adv, initial_lbd = 1.0, k = 1):
+    """ STEP I search of attack_targeted along theta: grow lbd by 1.05 until
+        x0 + lbd*theta is adversarial, locate the first crossing on a grid of
+        (0, lbd] and bisect it to 1e-7 (k-ary if k > 1)
+    """
+    if k > 1:
+        return (yield from boundary_search.initial_search_targeted(probe, theta, is_adv, initial_lbd, 1e-7, 100, k))
     nquery = 0
     lbd = initial_lbd
 
-    while model.predict(x0 + lbd*theta) != t:
+    while not is_adv((yield from ask(probe.point(theta, lbd)))):
         lbd *= 1.05
         nquery += 1
-        if lbd > 100: 
+        if lbd > 100:
             return float('inf'), nquery
 
     num_intervals = 100
@@ -171,7 +306,7 @@ def fine_grained_binary_search_targeted(model, x0, y0, t, theta, initial_lbd = 1
     lbd_hi_index = 0
     for i, lbd in enumerate(lambdas):
         nquery += 1
-        if model.predict(x0 + lbd*theta) == t:
+        if is_adv((yield from ask(probe.point(theta, lbd)))):
             lbd_hi = lbd
             lbd_hi_index = i
             break
@@ -181,7 +316,7 @@ def fine_grained_binary_search_targeted(model, x0, y0, t, theta, initial_lbd = 1
     while (lbd_hi - lbd_lo) > 1e-7:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0 + lbd_mid*theta) == t:
+        if is_adv((yield from ask(probe.point(theta, lbd_mid)))):
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
@@ -190,161 +325,286 @@ def fine_grained_binary_search_targeted(model, x0, y0, t, theta, initial_lbd = 1
 
 
 
-def attack_untargeted(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001, iterations = 1000):
+def attack_untargeted(model, *args, **kwargs):
+    """ attack_untargeted_steps(model, ...) run synchronously on model """
+    return run(model, attack_untargeted_steps(model, *args, **kwargs))
+
+def attack_untargeted_steps(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001, iterations = 1000, batch_directions = False, parallel_line_search = False, search_k = 1, prediction_index = None, neighbor_index = None, num_neighbors = 20, subspace = None, checkpoint = None, checkpoint_every = 50, budget = None, candidates = None, seed = None):
     """ Attack the original image and return adversarial example
         model: (pytorch model)
         train_dataset: set of training data
         (x0, y0): original image
+        batch_directions: search the q random directions together with predict_batch
+        parallel_line_search: resolve all step sizes of the line search together
+        search_k: points per round of the boundary searches (1 is bisection,
+                  'auto' picks it from the model's batch cost curve)
+        prediction_index: PredictionIndex of model on train_dataset; STEP I then
+                          samples only training images of a suitable class
+        neighbor_index: NeighborIndex over train_dataset; STEP I then only tries
+                        the num_neighbors closest training images of a suitable class
+        subspace: LowResolution or LowFrequency subspace the STEP II random
+                  directions are drawn in (full pixel space if None)
+        checkpoint: file the STEP II state is saved to every checkpoint_every
+                    iterations; if it exists the attack resumes from it
+        budget: Budget (queries, seconds, distortion plateau) after which the
+                attack stops and returns the best example found so far
+        candidates: (training indices, their images or None) STEP I tries,
+                    prefetched by pipeline.attack_jobs; drawn here if None
+        seed: draw the STEP I samples and STEP II directions from generators
+              seeded with seed, so that the attack does not depend on the
+              attacks it is interleaved with (global RNGs if None)
     """
 
-    if (model.predict(x0) != y0):
+    probe = RayProbe(model, x0)
+    if (yield from ask(probe.image(x0))) != y0:
         print("Fail to classify the image. No need to attack.")
         return x0
-
-    num_samples = 1000
-    best_theta, g_theta = None, float('inf')
-    query_count = 0
-
-    print("Searching for the initial direction on %d samples: " % (num_samples))
-    timestart = time.time()
-    samples = set(random.sample(range(len(train_dataset)), num_samples))
-    for i, (xi, yi) in enumerate(train_dataset):
-        if i not in samples:
-            continue
-        query_count += 1
-        if model.predict(xi) != y0:
+    if budget is not None:
+        budget.start()
+    if search_k == 'auto':
+        search_k = boundary_search.choose_k(model, x0)
+        print("Using %d-ary boundary search" % search_k)
+    sampler, rng = seeded(seed)
+    is_adv = lambda predicted: predicted != y0
+
+    state = load_checkpoint(checkpoint)
+    if state is not None:
+        best_theta, g_theta, query_count = state['best_theta'], state['g_theta'], state['query_count']
+    else:
+        num_samples = 1000
+        best_theta, g_theta = None, float('inf')
+        query_count = 0
+
+        if neighbor_index is not None:
+            num_samples = num_neighbors
+        print("Searching for the initial direction on %d samples: " % (num_samples))
+        timestart = time.time()
+        images = None
+        if candidates is not None:
+            samples, images = candidates
+        elif neighbor_index is not None:
+            samples, _ = neighbor_index.search(x0, num_neighbors, exclude = y0)
+        elif prediction_index is not None:
+            samples = prediction_index.sample(num_samples, exclude = y0, rng = sampler)
+        else:
+            samples = sorted(sampler.sample(range(len(train_dataset)), num_samples))
+        checked = prediction_index is not None if neighbor_index is None else neighbor_index.predicted
+        for n, i in enumerate(samples):
+            if budget is not None and best_theta is not None and (budget.reached(g_theta) or budget.exhausted(query_count)):
+                break
+            xi = images[n] if images is not None else train_dataset[i][0]
+            if not checked:
+                query_count += 1
+                if (yield from ask(probe.image(xi))) == y0:
+                    continue
             theta = xi - x0
-            initial_lbd = torch.norm(theta)
+            initial_lbd = torch.norm(theta).item()
             theta = theta/torch.norm(theta)
-            lbd, count = fine_grained_binary_search(model, x0, y0, theta, initial_lbd, g_theta)
+            lbd, count = yield from initial_search_steps(probe, theta, is_adv, initial_lbd, g_theta, k = search_k)
             query_count += count
             if lbd < g_theta:
                 best_theta, g_theta = theta, lbd
                 print("--------> Found distortion %.4f" % g_theta)
 
-    timeend = time.time()
-    print("==========> Found best distortion %.4f in %.4f seconds using %d queries" % (g_theta, timeend-timestart, query_count))
+        timeend = time.time()
+        print("==========> Found best distortion %.4f in %.4f seconds using %d queries" % (g_theta, timeend-timestart, query_count))
+        if best_theta is None:
+            print("Couldn't find a valid initial direction, failed")
+            return x0
 
-    
-    
-    timestart = time.time()
-    g1 = 1.0
-    theta, g2 = best_theta.clone(), g_theta
-    torch.manual_seed(0)
-    opt_count = 0
-    stopping = 0.01
-    prev_obj = 100000
-    for i in range(iterations):
-        gradient = torch.zeros(theta.size())
-        q = 10
-        min_g1 = float('inf')
-        for _ in range(q):
-            u = torch.randn(theta.size()).type(torch.FloatTensor)
-            u = u/torch.norm(u)
-            ttt = theta+beta * u
-            ttt = ttt/torch.norm(ttt)
-            g1, count = fine_grained_binary_search_local(model, x0, y0, ttt, initial_lbd = g2, tol=beta/500)
-            opt_count += count
-            gradient += (g1-g2)/beta * u
-            if g1 < min_g1:
-                min_g1 = g1
-                min_ttt = ttt
-        gradient = 1.0/q * gradient
-
-        if (i+1)%50 == 0:
-            print("Iteration %3d: g(theta + beta*u) = %.4f g(theta) = %.4f distortion %.4f num_queries %d" % (i+1, g1, g2, torch.norm(g2*theta), opt_count))
-            if g2 > prev_obj-stopping:
-                break
-            prev_obj = g2
 
-        min_theta = theta
-        min_g2 = g2
-    
-        for _ in range(15):
-            new_theta = theta - alpha * gradient
-            new_theta = new_theta/torch.norm(new_theta)
-            new_g2, count = fine_grained_binary_search_local(model, x0, y0, new_theta, initial_lbd = min_g2, tol=beta/500)
-            opt_count += count
-            alpha = alpha * 2
-            if new_g2 < min_g2:
-                min_theta = new_theta 
-                min_g2 = new_g2
-            else:
-                break
 
-        if min_g2 >= g2:
-            for _ in range(15):
-                alpha = alpha * 0.25
-                new_theta = theta - alpha * gradient
-                new_theta = new_theta/torch.norm(new_theta)
-                new_g2, count = fine_grained_binary_search_local(model, x0, y0, new_theta, initial_lbd = min_g2, tol=beta/500)
-                opt_count += count
-                if new_g2 < g2:
-                    min_theta = new_theta 
-                    min_g2 = new_g2
-                    break
-
-        if min_g2 <= min_g1:
-            theta, g2 = min_theta, min_g2
-        else:
-            theta, g2 = min_ttt, min_g1
-
-        if g2 < g_theta:
-            best_theta, g_theta = theta.clone(), g2
-        
-        #print(alpha)
-        if alpha < 1e-4:
-            alpha = 1.0
-            print("Warning: not moving, g2 %lf gtheta %lf" % (g2, g_theta))
-            beta = beta * 0.1
-            if (beta < 0.0005):
-                break
+    timestart = time.time()
+    if rng is None:
+        torch.manual_seed(0)
+    best_theta, g_theta, opt_count, unused_count = yield from optimize_steps(probe, best_theta, g_theta, is_adv, 20, alpha, beta, iterations, query_count,
+            batch_directions, parallel_line_search, search_k, subspace, stopping = 0.01, checkpoint = checkpoint, checkpoint_every = checkpoint_every, budget = budget, state = state, rng = rng)
 
-    target = model.predict(x0 + g_theta*best_theta)
+    clear_checkpoint(checkpoint)
+    target = yield from ask(probe.point(best_theta, g_theta))
     timeend = time.time()
     print("\nAdversarial Example Found Successfully: distortion %.4f target %d queries %d \nTime: %.4f seconds" % (g_theta, target, query_count + opt_count, timeend-timestart))
+    if parallel_line_search:
+        print("Parallel line search spent %d queries on steps whose result the serial search did not use" % unused_count)
     return x0 + g_theta*best_theta
 
-def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = 1.0, tol=1e-5):
+def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = 1.0, tol=1e-5, k = 1, probe = None):
+    return run(model, local_search_steps(probe or RayProbe(model, x0), theta, lambda predicted: predicted != y0, initial_lbd, tol, 20, k))
+
+def local_search_steps(probe, theta, is_adv, initial_lbd = 1.0, tol=1e-5, max_lbd = 20, k = 1):
+    """ STEP II search along theta: step lbd from initial_lbd by 1.01 (0.99)
+        until it crosses the boundary, then bisect the bracket to tol (k-ary
+        if k > 1); inf once lbd passes max_lbd
+    """
+    if k > 1:
+        return (yield from boundary_search.local_search(probe, theta, is_adv, initial_lbd, tol, max_lbd, k))
     nquery = 0
     lbd = initial_lbd
-     
-    if model.predict(x0+lbd*theta) == y0:
+
+    if not is_adv((yield from ask(probe.point(theta, lbd)))):
         lbd_lo = lbd
         lbd_hi = lbd*1.01
         nquery += 1
-        while model.predict(x0+lbd_hi*theta) == y0:
+        while not is_adv((yield from ask(probe.point(theta, lbd_hi)))):
             lbd_hi = lbd_hi*1.01
             nquery += 1
-            if lbd_hi > 20:
+            if lbd_hi > max_lbd:
                 return float('inf'), nquery
     else:
         lbd_hi = lbd
         lbd_lo = lbd*0.99
         nquery += 1
-        while model.predict(x0+lbd_lo*theta) != y0 :
+        while is_adv((yield from ask(probe.point(theta, lbd_lo)))):
             lbd_lo = lbd_lo*0.99
             nquery += 1
 
     while (lbd_hi - lbd_lo) > tol:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0 + lbd_mid*theta) != y0:
+        if is_adv((yield from ask(probe.point(theta, lbd_mid)))):
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
     return lbd_hi, nquery
 
-def fine_grained_binary_search(model, x0, y0, theta, initial_lbd, current_best):
+def batch_local_search_steps(probe, thetas, is_adv, initial_lbd = 1.0, tol=1e-5, max_lbd = 20, bound = None, drop_after = None):
+    """ Run local_search_steps on every row of thetas at once
+        Each direction keeps its own [lbd_lo, lbd_hi] bracket and search phase,
+        and every round asks one query per unfinished direction in a single
+        batch. The points and counts are those of the scalar search, but a
+        batched forward pass rounds differently from a single-image one, so a
+        label right at the boundary can flip: lbd then moves by less than tol
+        and STEP II may take a different path from there.
+        is_adv: maps a tensor of predicted labels to a byte mask
+        bound: a direction known to end at or above bound (benign there) stops
+               with lbd inf, for callers that only need to know it is not below
+        drop_after: 'above' ('below') stops every direction after the first one
+                    known to end at or above (below) bound, with lbd inf
+        output: lists of lbd_hi and of query counts per direction
+    """
+    INIT, UP, DOWN, BISECT, DONE = 0, 1, 2, 3, 4
+    n = thetas.size(0)
+    lbd_lo = torch.DoubleTensor(n).fill_(float(initial_lbd))
+    lbd_hi = lbd_lo.clone()
+    phase = torch.LongTensor(n).fill_(INIT)
+    nquery = torch.LongTensor(n).zero_()
+
+    while True:
+        converged = (phase == BISECT) & ((lbd_hi - lbd_lo) <= tol)
+        phase[converged] = DONE
+        active = (phase != DONE).nonzero().view(-1)
+        if active.numel() == 0:
+            break
+        p = phase[active]
+        lbd = torch.where(p == UP, lbd_hi[active], lbd_lo[active])
+        lbd = torch.where(p == BISECT, (lbd_lo[active] + lbd_hi[active])/2.0, lbd)
+        adv = is_adv((yield probe.points(thetas, lbd, active))).cpu().bool()
+
+        for j, k in enumerate(active.tolist()):
+            ph, l, a = phase[k].item(), lbd[j].item(), adv[j].item()
+            if ph == INIT:
+                nquery[k] += 1
+                if a:
+                    lbd_hi[k], lbd_lo[k], phase[k] = l, l*0.99, DOWN
+                else:
+                    lbd_lo[k], lbd_hi[k], phase[k] = l, l*1.01, UP
+            elif ph == UP:
+                if a:
+                    phase[k] = BISECT
+                else:
+                    lbd_hi[k] = l*1.01
+                    nquery[k] += 1
+                    if l*1.01 > max_lbd:
+                        lbd_hi[k], phase[k] = float('inf'), DONE
+            elif ph == DOWN:
+                if a:
+                    lbd_lo[k] = l*0.99
+                    nquery[k] += 1
+                else:
+                    phase[k] = BISECT
+            else:
+                nquery[k] += 1
+                if a:
+                    lbd_hi[k] = l
+                else:
+                    lbd_lo[k] = l
+
+        if bound is not None:
+            # lbd_lo has been answered benign in these phases
+            above = ((phase == UP) | (phase == BISECT)) & (lbd_lo >= bound)
+            lbd_hi[above], phase[above] = float('inf'), DONE
+            if drop_after is not None:
+                if drop_after == 'above':
+                    decided = (lbd_hi == float('inf')).nonzero().view(-1)
+                else:
+                    decided = (((phase == DOWN) | (phase == BISECT) | (phase == DONE)) & (lbd_hi < bound)).nonzero().view(-1)
+                if decided.numel() > 0:
+                    later = (phase != DONE).nonzero().view(-1)
+                    later = later[later > decided[0]]
+                    lbd_hi[later], phase[later] = float('inf'), DONE
+    return lbd_hi.tolist(), nquery.tolist()
+
+def batch_line_search_steps(probe, theta, gradient, alpha, g2, is_adv, tol=1e-5, max_lbd = 20, steps = 15):
+    """ Step-size search of STEP II with each ladder resolved in one batched search
+        The doubling steps alpha*2^k are searched together, and the quartering
+        steps 2*alpha*0.25^k only if none of them improved on g2, then the
+        serial rules are replayed on the results to pick the step. A step stops
+        being searched once it is known not to end below g2, or once an earlier
+        step already ends the ladder.
+        output: min_theta, min_g2, next alpha, queries spent, and the queries
+                spent on steps whose result the serial rules did not use
+    """
+    def ladder(alphas, drop_after):
+        thetas = []
+        for step in alphas:
+            new_theta = theta - step * gradient
+            thetas.append(new_theta/torch.norm(new_theta))
+        lbds, counts = yield from batch_local_search_steps(probe, torch.stack(thetas), is_adv, initial_lbd = g2, tol = tol, max_lbd = max_lbd, bound = g2, drop_after = drop_after)
+        return thetas, lbds, counts
+
+    min_theta, min_g2 = theta, g2
+    doubling = [alpha * 2**k for k in range(steps)]
+    thetas, lbds, counts = yield from ladder(doubling, 'above')
+    spent, used = sum(counts), 0
+    for k in range(steps):
+        used += counts[k]
+        alpha = doubling[k] * 2
+        if lbds[k] < min_g2:
+            min_theta, min_g2 = thetas[k], lbds[k]
+        else:
+            break
+
+    if min_g2 >= g2:
+        quartering = [alpha * 0.25**k for k in range(1, steps+1)]
+        thetas, lbds, counts = yield from ladder(quartering, 'below')
+        spent += sum(counts)
+        for k in range(steps):
+            used += counts[k]
+            alpha = quartering[k]
+            if lbds[k] < g2:
+                min_theta, min_g2 = thetas[k], lbds[k]
+                break
+    return min_theta, min_g2, alpha, spent, spent - used
+
+def fine_grained_binary_search(model, x0, y0, theta, initial_lbd, current_best, k = 1, probe = None):
+    return run(model, initial_search_steps(probe or RayProbe(model, x0), theta, lambda predicted: predicted != y0, initial_lbd, current_best, k))
+
+def initial_search_steps(probe, theta, is_adv, initial_lbd, current_best, k = 1):
+    """ STEP I search of attack_untargeted along theta: bisect [0, lbd] to 1e-5
+        with lbd = min(initial_lbd, current_best), or give up at once if theta
+        cannot beat current_best (k-ary if k > 1)
+    """
+    if k > 1:
+        return (yield from boundary_search.initial_search(probe, theta, is_adv, initial_lbd, current_best, 1e-5, k))
     nquery = 0
-    if initial_lbd > current_best: 
-        if model.predict(x0+current_best*theta) == y0:
+    if initial_lbd > current_best:
+        if not is_adv((yield from ask(probe.point(theta, current_best)))):
             nquery += 1
             return float('inf'), nquery
         lbd = current_best
     else:
         lbd = initial_lbd
-    
+
     ## original version
     #lbd = initial_lbd
     #while model.predict(x0 + lbd*theta) == y0:
@@ -352,7 +612,7 @@ def fine_grained_binary_search(model, x0, y0, theta, initial_lbd, current_best):
     #    nquery += 1
     #    if lbd > 100:
     #        return float('inf'), nquery
-    
+
     #num_intervals = 100
 
     # lambdas = np.linspace(0.0, lbd, num_intervals)[1:]
@@ -372,37 +632,44 @@ def fine_grained_binary_search(model, x0, y0, theta, initial_lbd, current_best):
     while (lbd_hi - lbd_lo) > 1e-5:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0 + lbd_mid*theta) != y0:
+        if is_adv((yield from ask(probe.point(theta, lbd_mid)))):
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
     return lbd_hi, nquery
 
-def attack_mnist(alpha=0.2, beta=0.001, isTarget= False, num_attacks= 100):
+# test images attacked by the drivers (and by runner.py)
+mnist_samples = [6312, 6891, 4243, 8377, 7962, 6635, 4970, 7809, 5867, 9559, 3579, 8269, 2282, 4618, 2290, 1554, 4105, 9862, 2408, 5082, 1619, 1209, 5410, 7736, 9172, 1650, 5181, 3351, 9053, 7816, 7254, 8542, 4268, 1021, 8990, 231, 1529, 6535, 19, 8087, 5459, 3997, 5329, 1032, 3131, 9299, 3910, 2335, 8897, 7340, 1495, 5244,8323, 8017, 1787, 4939, 9032, 4770, 2045, 8970, 5452, 8853, 3330, 9883, 8966, 9628, 4713, 7291, 9770, 6307, 5195, 9432, 3967, 4757, 3013, 3103, 3060, 541, 4261, 7808, 1132, 1472, 2134, 634, 1315, 8858, 6411, 8595, 4516, 8550, 3859, 3526]
+cifar10_samples = [6311, 6890, 663, 4242, 8376, 7961, 6634, 4969, 7808, 5866, 9558, 3578, 8268, 2281, 2289, 1553, 4104, 8725, 9861, 2407, 5081, 1618, 1208, 5409, 7735, 9171, 1649, 5796, 7113, 5180, 3350,9052, 7253, 8541, 4267, 1020, 8989, 230, 1528, 6534, 18, 8086, 3996, 1031, 3130, 9298, 3632, 3909, 2334, 8896, 7339, 1494, 5243, 8322, 8016, 1786, 9031, 4769, 8969, 5451, 8852, 3329, 9882, 8965, 9627, 4712, 7290, 9769, 6306, 5194, 3966, 4756, 3012, 3102, 540, 4260, 7807, 1471, 2133, 2450, 633, 1314, 8857, 6410, 8594, 4515, 8549, 3858, 3525, 6411, 4360, 7753, 7413, 684,3343, 6785, 7079, 2263]
+imagenet_samples = [25248, 27563, 2654, 16969, 31846, 26538, 19878, 14316, 33076, 9128, 9159, 49533, 34903, 46215, 9632, 20326, 6473, 48334, 4826, 21640, 6600, 23187, 40036, 41971, 13401, 36211, 31262, 4082, 35960, 6113, 47167, 46548, 75, 40102, 32348, 21313, 46114, 4128,37193, 14530, 9339, 5978, 20976, 33289]
+
+def attack_mnist(alpha=0.2, beta=0.001, isTarget= False, num_attacks= 100, use_index= False, use_cache= False, checkpoint_dir= None, resume= False, budget= None, prefetch_depth= 2, device= None, num_threads= None):
     train_loader, test_loader, train_dataset, test_dataset = load_mnist_data()
     print("Length of test_set: ", len(test_dataset))
     dataset = train_dataset
 
-    net = MNIST()
-    if torch.cuda.is_available():
-        net.cuda()
-        net = torch.nn.DataParallel(net, device_ids=[0])
+    policy = DevicePolicy(device, num_threads = num_threads)
+    net = policy.module(MNIST())
         
     load_model(net, 'models/mnist_gpu.pt')
     #load_model(net, 'models/mnist_cpu.pt')
     net.eval()
 
-    model = net.module if torch.cuda.is_available() else net
+    model = unwrap(net)
+    model.policy = policy
+    index = load_prediction_index(model, dataset, 'mnist', 'models/mnist_gpu.pt') if use_index else None
+    if use_cache:
+        model = load_decision_cache(model, 'mnist', 'models/mnist_gpu.pt')
 
-    def single_attack(image, label, target = None):
+    def single_attack(image, label, target = None, checkpoint = None, candidates = None):
         show_image(image.numpy())
         print("Original label: ", label)
         print("Predicted label: ", model.predict(image))
         if target == None:
-            adversarial = attack_untargeted(model, dataset, image, label, alpha = alpha, beta = beta, iterations = 1000)
+            adversarial = attack_untargeted(model, dataset, image, label, alpha = alpha, beta = beta, iterations = 1000, prediction_index = index, checkpoint = checkpoint, budget = budget, candidates = candidates)
         else:
             print("Targeted attack: %d" % target)
-            adversarial = attack_targeted(model, dataset, image, label, target, alpha = alpha, beta = beta, iterations = 1000)
+            adversarial = attack_targeted(model, dataset, image, label, target, alpha = alpha, beta = beta, iterations = 1000, prediction_index = index, checkpoint = checkpoint, budget = budget, candidates = candidates)
         show_image(adversarial.numpy())
         print("Predicted label for adversarial example: ", model.predict(adversarial))
         return torch.norm(adversarial - image)
@@ -410,91 +677,133 @@ def attack_mnist(alpha=0.2, beta=0.001, isTarget= False, num_attacks= 100):
     print("\n\n Running {} attack on {} random  MNIST test images for alpha= {} beta= {}\n\n".format("targetted" if isTarget else "untargetted", num_attacks, alpha, beta))
     total_distortion = 0.0
 
-    samples = [6312, 6891, 4243, 8377, 7962, 6635, 4970, 7809, 5867, 9559, 3579, 8269, 2282, 4618, 2290, 1554, 4105, 9862, 2408, 5082, 1619, 1209, 5410, 7736, 9172, 1650, 5181, 3351, 9053, 7816, 7254, 8542, 4268, 1021, 8990, 231, 1529, 6535, 19, 8087, 5459, 3997, 5329, 1032, 3131, 9299, 3910, 2335, 8897, 7340, 1495, 5244,8323, 8017, 1787, 4939, 9032, 4770, 2045, 8970, 5452, 8853, 3330, 9883, 8966, 9628, 4713, 7291, 9770, 6307, 5195, 9432, 3967, 4757, 3013, 3103, 3060, 541, 4261, 7808, 1132, 1472, 2134, 634, 1315, 8858, 6411, 8595, 4516, 8550, 3859, 3526]
+    samples = mnist_samples
+    progress = RunProgress(os.path.join(checkpoint_dir, 'mnist-progress.ckpt'), resume) if checkpoint_dir is not None else None
     #true_labels = [3, 1, 6, 6, 9, 2, 7, 5, 5, 3, 3, 4, 5, 6, 7, 9, 1, 6, 3, 4, 0, 6, 5, 9, 7, 0, 3, 1, 6, 6, 9, 6, 4, 7, 6, 3, 4, 3, 4, 3, 0, 7, 3, 5, 3, 9, 3, 1, 9, 1, 3, 0, 2, 9, 9, 2, 2, 3, 3, 3, 0, 5, 2, 5, 2, 7, 2, 2, 5, 7, 4, 9, 9, 0, 0, 7, 9, 4, 5, 5, 2, 3, 5, 9, 3, 0, 9, 0, 1, 2, 9, 9]
-    for idx in samples:
-        #idx = random.randint(100, len(test_dataset)-1)
-        image, label = test_dataset[idx]
+    done = [idx for idx in samples if progress is not None and idx in progress]
+    total_distortion += sum(progress[idx] for idx in done)
+    target_of = (lambda idx, label: choose_target('mnist', label, idx)) if isTarget else None
+    jobs = attack_jobs(test_dataset, [idx for idx in samples if idx not in done], target_of, dataset, prediction_index = index, place = policy.pin)
+    for job in prefetch(jobs, prefetch_depth):
+        idx, image, label, target = job['index'], job['image'], job['label'], job['target']
         print("\n\n\n\n======== Image %d =========" % idx)
-        #target = None if not isTarget else random.choice(list(range(label)) + list(range(label+1, 10)))
-        target = None if not isTarget else (1+label) % 10
-        total_distortion += single_attack(image, label, target)
+        checkpoint = progress.checkpoint(idx) if progress is not None else None
+        if not resume:
+            clear_checkpoint(checkpoint)
+        distortion = single_attack(image, label, target, checkpoint, job['candidates'])
+        total_distortion += distortion
+        if progress is not None:
+            progress.record(idx, distortion)
     
     print("Average distortion on random {} images is {}".format(num_attacks, total_distortion/num_attacks))
+    if use_cache:
+        model.save()
+        print("Decision cache: %(hits)d hits, %(misses)d forward passes, %(entries)d stored" % model.stats())
 
 
-def attack_cifar10(alpha= 0.2, beta= 0.001, isTarget= False, num_attacks= 100):
+def attack_cifar10(alpha= 0.2, beta= 0.001, isTarget= False, num_attacks= 100, use_index= False, use_cache= False, checkpoint_dir= None, resume= False, budget= None, prefetch_depth= 2, device= None, num_threads= None):
     train_loader, test_loader, train_dataset, test_dataset = load_cifar10_data()
     dataset = train_dataset
     print("Length of test_set: ", len(test_dataset))
-    net = CIFAR10()
-    if torch.cuda.is_available():
-        net.cuda()
-        net = torch.nn.DataParallel(net, device_ids=[0])
+    policy = DevicePolicy(device, num_threads = num_threads)
+    net = policy.module(CIFAR10())
         
     load_model(net, 'models/cifar10_gpu.pt')
     #load_model(net, 'models/cifar10_cpu.pt')
     net.eval()
 
-    model = net.module if torch.cuda.is_available() else net
+    model = unwrap(net)
+    model.policy = policy
+    index = load_prediction_index(model, dataset, 'cifar10', 'models/cifar10_gpu.pt') if use_index else None
+    if use_cache:
+        model = load_decision_cache(model, 'cifar10', 'models/cifar10_gpu.pt')
 
-    def single_attack(image, label, target = None):
+    def single_attack(image, label, target = None, checkpoint = None, candidates = None):
         print("Original label: ", label)
         print("Predicted label: ", model.predict(image))
         if target == None:
-            adversarial = attack_untargeted(model, dataset, image, label, alpha = alpha, beta = beta, iterations = 1000)
+            adversarial = attack_untargeted(model, dataset, image, label, alpha = alpha, beta = beta, iterations = 1000, prediction_index = index, checkpoint = checkpoint, budget = budget, candidates = candidates)
         else:
             print("Targeted attack: %d" % target)
-            adversarial = attack_targeted(model, dataset, image, label, target, alpha = alpha, beta = beta, iterations = 1000)
+            adversarial = attack_targeted(model, dataset, image, label, target, alpha = alpha, beta = beta, iterations = 1000, prediction_index = index, checkpoint = checkpoint, budget = budget, candidates = candidates)
         print("Predicted label for adversarial example: ", model.predict(adversarial))
         return torch.norm(adversarial - image)
 
     print("\n\nRunning {} attack on {} random CIFAR10 test images for alpha= {} beta= {}\n\n".format("targetted" if isTarget else "untargetted", num_attacks, alpha, beta))
     total_distortion = 0.0
 
-    samples = [6311, 6890, 663, 4242, 8376, 7961, 6634, 4969, 7808, 5866, 9558, 3578, 8268, 2281, 2289, 1553, 4104, 8725, 9861, 2407, 5081, 1618, 1208, 5409, 7735, 9171, 1649, 5796, 7113, 5180, 3350,9052, 7253, 8541, 4267, 1020, 8989, 230, 1528, 6534, 18, 8086, 3996, 1031, 3130, 9298, 3632, 3909, 2334, 8896, 7339, 1494, 5243, 8322, 8016, 1786, 9031, 4769, 8969, 5451, 8852, 3329, 9882, 8965, 9627, 4712, 7290, 9769, 6306, 5194, 3966, 4756, 3012, 3102, 540, 4260, 7807, 1471, 2133, 2450, 633, 1314, 8857, 6410, 8594, 4515, 8549, 3858, 3525, 6411, 4360, 7753, 7413, 684,3343, 6785, 7079, 2263] 
+    samples = cifar10_samples
+    progress = RunProgress(os.path.join(checkpoint_dir, 'cifar10-progress.ckpt'), resume) if checkpoint_dir is not None else None
     #true_labels = [3, 5, 6, 8, 7, 3, 4, 1, 8, 4, 0, 7, 5, 5, 1, 4, 0, 8, 6, 9, 5, 7, 3, 1, 4, 2, 5, 5, 9, 9, 8, 0, 4, 8, 7, 1, 4, 5, 2, 7, 8, 4, 6, 3, 3, 1, 1, 5, 1, 8, 6, 7, 1, 4, 4, 1, 0, 8, 8, 6, 7, 3, 1, 4, 4, 4, 6, 8, 0, 7, 4, 6, 1, 0, 1, 8, 3, 8, 3, 1, 8, 9, 0, 1, 3, 0, 1, 8, 2, 8, 6, 9, 1, 9, 3, 6, 7, 6]
     #samples = [7753, 1314, 633]
     samples = [6311]
-    for idx in samples:
-        #idx = random.randint(100, len(test_dataset)-1)
-        image, label = test_dataset[idx]
+    done = [idx for idx in samples if progress is not None and idx in progress]
+    total_distortion += sum(progress[idx] for idx in done)
+    target_of = (lambda idx, label: choose_target('cifar10', label, idx)) if isTarget else None
+    jobs = attack_jobs(test_dataset, [idx for idx in samples if idx not in done], target_of, dataset, prediction_index = index, place = policy.pin)
+    for job in prefetch(jobs, prefetch_depth):
+        idx, image, label, target = job['index'], job['image'], job['label'], job['target']
         print("\n\n\n\n======== Image %d =========" % idx)
-        #target = None if not isTarget else random.choice(list(range(label)) + list(range(label+1, 10)))
-        target = None if not isTarget else (1+label) % 10
-        total_distortion += single_attack(image, label, target)
+        checkpoint = progress.checkpoint(idx) if progress is not None else None
+        if not resume:
+            clear_checkpoint(checkpoint)
+        distortion = single_attack(image, label, target, checkpoint, job['candidates'])
+        total_distortion += distortion
+        if progress is not None:
+            progress.record(idx, distortion)
     print("Average distortion on random {} images is {}".format(num_attacks, total_distortion/num_attacks))
+    if use_cache:
+        model.save()
+        print("Decision cache: %(hits)d hits, %(misses)d forward passes, %(entries)d stored" % model.stats())
 
-def attack_imagenet(arch='resnet50', alpha=0.2, beta= 0.001, isTarget=False, num_attacks = 100):
+def attack_imagenet(arch='resnet50', alpha=0.2, beta= 0.001, isTarget=False, num_attacks = 100, use_index = False, use_cache = False, basis = None, checkpoint_dir = None, resume = False, budget = None, prefetch_depth = 2, device = None, num_threads = None):
     train_loader, test_loader, train_dataset, test_dataset = load_imagenet_data()
     dataset = test_dataset
     print("Length of test_set: ", len(test_dataset))
 
-    model = IMAGENET(arch)
+    policy = DevicePolicy(device, num_threads = num_threads)
+    model = IMAGENET(arch, policy)
+    index = load_prediction_index(model, dataset, 'imagenet-' + arch, model.checkpoint) if use_index else None
+    if use_cache:
+        model = load_decision_cache(model, 'imagenet-' + arch, model.checkpoint, bounds = (-1, 1))
+    subspace = make_subspace(basis, (3, 224, 224)) if basis is not None else None
 
-    def attack_single(image, label, target = None):
+    def attack_single(image, label, target = None, checkpoint = None, candidates = None):
         print("Original label: ", label)
         print("Predicted label: ", model.predict(image))
         if target == None:
-            adversarial = attack_untargeted(model, dataset, image, label, alpha = alpha, beta = beta, iterations = 1500)
+            adversarial = attack_untargeted(model, dataset, image, label, alpha = alpha, beta = beta, iterations = 1500, prediction_index = index, subspace = subspace, checkpoint = checkpoint, budget = budget, candidates = candidates)
         else:
             print("Targeted attack: %d" % target)
-            adversarial = attack_targeted(model, dataset, image, label, target, alpha = alpha, beta = beta, iterations = 1500)
+            adversarial = attack_targeted(model, dataset, image, label, target, alpha = alpha, beta = beta, iterations = 1500, prediction_index = index, subspace = subspace, checkpoint = checkpoint, budget = budget, candidates = candidates)
         print("Predicted label for adversarial example: ", model.predict(adversarial))
         return torch.norm(adversarial - image)
 
     print("\nRunning {} attack on {} random IMAGENET test images for alpha= {} beta= {} using {}\n".format("targetted" if isTarget else "untargetted", num_attacks, alpha, beta, arch))
     total_distortion = 0.0
 
-    samples = [25248, 27563, 2654, 16969, 31846, 26538, 19878, 14316, 33076, 9128, 9159, 49533, 34903, 46215, 963220326, 6473, 483344826,216406600, 23187, 40036, 41971, 13401, 36211, 31262, 4082, 35960, 6113, 47167, 46548, 75, 40102, 32348, 21313, 46114, 4128,37193, 14530, 9339, 5978, 20976, 33289]
-    for idx in samples:
-        #idx = random.randint(100, len(test_dataset)-1)
-        image, label = test_dataset[idx]
+    samples = imagenet_samples
+    progress = RunProgress(os.path.join(checkpoint_dir, 'imagenet-progress.ckpt'), resume) if checkpoint_dir is not None else None
+    done = [idx for idx in samples if progress is not None and idx in progress]
+    total_distortion += sum(progress[idx] for idx in done)
+    target_of = (lambda idx, label: choose_target('imagenet', label, idx)) if isTarget else None
+    # 1000 candidate crops are 600MB: prefetch their indices only
+    jobs = attack_jobs(test_dataset, [idx for idx in samples if idx not in done], target_of, dataset, prediction_index = index, load_candidates = False, place = policy.pin)
+    for job in prefetch(jobs, prefetch_depth):
+        idx, image, label, target = job['index'], job['image'], job['label'], job['target']
         print("\n\n======== Image %d =========" % idx)
-        target = None if not isTarget else random.choice(list(range(label)) + list(range(label+1, 1000)))
-        total_distortion += attack_single(image, label, target)
+        checkpoint = progress.checkpoint(idx) if progress is not None else None
+        if not resume:
+            clear_checkpoint(checkpoint)
+        distortion = attack_single(image, label, target, checkpoint, job['candidates'])
+        total_distortion += distortion
+        if progress is not None:
+            progress.record(idx, distortion)
     
     print("Average distortion on random {} images is {}".format(num_attacks, total_distortion/num_attacks))
+    if use_cache:
+        model.save()
+        print("Decision cache: %(hits)d hits, %(misses)d forward passes, %(entries)d stored" % model.stats())
 
 if __name__ == '__main__':
     timestart = time.time()
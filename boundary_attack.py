@@ -7,22 +7,34 @@ import torchvision.datasets as dsets
 import torchvision.transforms as transforms
 from torch.autograd import Variable
 import torch.nn.functional as F
-from models import MNIST, CIFAR10, SimpleMNIST, load_mnist_data, load_cifar10_data, load_model, show_image
+from oracle import RayProbe
+from models import MNIST, CIFAR10, SimpleMNIST, DevicePolicy, unwrap, load_mnist_data, load_cifar10_data, load_model, show_image
 
 alpha = 0.2
 beta = 0.001
 
 
-def attack_untargeted(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001):
+def attack_untargeted(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001, num_proposals = 1, iterations = 1000000, patience = 100, min_improvement = 0.001, budget = None):
     """ Attack the original image and return adversarial example
         model: (pytorch model)
         train_dataset: set of training data
         (x0, y0): original image
+        num_proposals: if > 1, every step draws that many proposals and classifies
+                       them with one predict_batch (see batch_boundary_walk)
+        iterations: maximum number of steps
+        patience, min_improvement: with num_proposals > 1, stop once the distortion
+                                   has not dropped by a factor min_improvement
+                                   during patience steps
+        budget: Budget (queries, seconds, distortion plateau) after which the
+                attack stops and returns the best example found so far
     """
 
     if (model.predict(x0) != y0):
         print("Fail to classify the image. No need to attack.")
         return x0
+    if budget is not None:
+        budget.start()
+    probe = RayProbe(model, x0)
 
     num_samples = 1000
     best_theta = None
@@ -36,11 +48,13 @@ def attack_untargeted(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001):
     for i, (xi, yi) in enumerate(train_dataset):
         if i not in samples:
             continue
+        if budget is not None and best_theta is not None and (budget.reached(best_distortion) or budget.exhausted(query_count)):
+            break
         query_count += 1
         if model.predict(xi) != y0:
             theta = xi - x0
             #query_count += query_search_each
-            lbd, count = fine_grained_binary_search(model, x0, y0, theta)
+            lbd, count = fine_grained_binary_search(model, x0, y0, theta, probe = probe)
             query_count += count
             distortion = torch.norm(lbd*theta)
             if distortion < best_distortion:
@@ -56,9 +70,16 @@ def attack_untargeted(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001):
   
     timestart = time.time()
 
+    if num_proposals > 1:
+        now_o, opt_count = batch_boundary_walk(model, x0, y0, g_theta*best_theta, num_proposals, iterations, patience, min_improvement, budget = budget, spent = query_count)
+        distortion = torch.norm(now_o)
+        target = model.predict(x0+now_o)
+        timeend = time.time()
+        print("\nAdversarial Example Found Successfully: distortion %.4f target %d queries %d \nTime: %.4f seconds" % (distortion, target, query_count + opt_count, timeend-timestart))
+        return x0+now_o
+
     #query_search_each = 200  # limit for each lambda search
     #iterations = (query_limit - query_search_each)//(2*query_search_each)
-    iterations = 1000000
     g1 = 1.0
     g2 = g_theta
     theta = best_theta
@@ -70,6 +91,9 @@ def attack_untargeted(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001):
     success_count = 0
     n_adjust = 1000
     for i in range(iterations):
+        if budget is not None and budget.exhausted(query_count + 2*i, float(torch.norm(now_o))):
+            print("Stopping at iteration %d: %s" % (i, budget.reason))
+            break
         u = torch.randn(theta.size()).type(torch.FloatTensor)
         new_o = now_o + u*delta
         new_o = new_o *( torch.norm(now_o) / torch.norm(new_o))
@@ -98,38 +122,99 @@ def attack_untargeted(model, train_dataset, x0, y0, alpha = 0.2, beta = 0.001):
     print("\nAdversarial Example Found Successfully: distortion %.4f target %d queries %d \nTime: %.4f seconds" % (distortion, target, query_count + iterations, timeend-timestart))
     return x0+now_o
 
-def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = 1.0):
+def batch_boundary_walk(model, x0, y0, now_o, num_proposals = 64, iterations = 10000, patience = 100, min_improvement = 0.001, delta = 0.01, epsilon = 0.001, budget = None, spent = 0):
+    """ Boundary walk from the adversarial perturbation now_o, num_proposals at a time
+        Each step draws num_proposals random directions orthogonal to now_o,
+        makes a spherical step of relative size delta along each, then shrinks
+        each candidate by a factor (1-epsilon) towards x0. All 2*num_proposals
+        images are classified in one predict_batch, and the first adversarial
+        shrunk candidate is accepted. delta and epsilon follow the success
+        rates of the spherical and shrunk candidates, as in the Boundary Attack.
+        budget: Budget checked every step, spent queries having been used before
+        Returns the final perturbation and the number of queries.
+    """
+    n = num_proposals
+    nquery = 0
+    best_distortion = torch.norm(now_o)
+    stall = 0
+    for i in range(iterations):
+        if budget is not None and budget.exhausted(spent + nquery, float(best_distortion)):
+            print("Stopping at step %d: %s" % (i, budget.reason))
+            break
+        norm = torch.norm(now_o)
+        flat_o = now_o.view(1, -1)
+        u = torch.randn(n, flat_o.size(1))
+        u = u - u.mm(flat_o.t()) * flat_o / (norm*norm)
+        spherical = flat_o + delta * norm * u / u.norm(2, 1, keepdim=True)
+        spherical = spherical * (norm / spherical.norm(2, 1, keepdim=True))
+        shrunk = spherical * (1 - epsilon)
+        candidates = torch.cat([spherical, shrunk], 0).view((2*n,) + now_o.size())
+        predicted = model.predict_batch(candidates.add_(x0)).cpu()
+        nquery += 2*n
+        adv = (predicted != y0)
+        spherical_rate = float(adv[:n].sum())/n
+        shrunk_rate = float(adv[n:].sum())/n
+        if shrunk_rate > 0:
+            first = adv[n:].nonzero().view(-1)[0]
+            now_o = shrunk[first].view(now_o.size())
+
+        if spherical_rate < 0.2:
+            delta = delta / 1.5
+        elif spherical_rate > 0.5:
+            delta = delta * 1.5
+        if shrunk_rate < 0.2:
+            epsilon = epsilon / 1.5
+        elif shrunk_rate > 0.5:
+            epsilon = min(epsilon * 1.5, 0.5)
+
+        distortion = torch.norm(now_o)
+        if distortion < best_distortion * (1 - min_improvement):
+            best_distortion = distortion
+            stall = 0
+        else:
+            stall += 1
+            if stall >= patience:
+                print("Distortion plateau after %d steps" % (i+1))
+                break
+        if (i+1)%100 == 0:
+            print("Iteration %3d distortion %.4f delta %.5f epsilon %.5f query %d" % (i+1, distortion, delta, epsilon, nquery))
+    return now_o, nquery
+
+
+def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd = 1.0, probe = None):
+    predict = (probe or RayProbe(model, x0)).along(theta)
     nquery = 0
     lbd = initial_lbd
    
-    if model.predict(x0+lbd*theta) == y0:
+    if predict(lbd) == y0:
         lbd_lo = lbd
         lbd_hi = lbd*1.01
         nquery += 1
-        while model.predict(x0+lbd_hi*theta) == y0:
+        while predict(lbd_hi) == y0:
             lbd_hi = lbd_hi*1.01
             nquery += 1
     else:
         lbd_hi = lbd
         lbd_lo = lbd*0.99
         nquery += 1
-        while model.predict(x0+lbd_lo*theta) != y0 :
+        while predict(lbd_lo) != y0 :
             lbd_lo = lbd_lo*0.99
             nquery += 1
 
     while (lbd_hi - lbd_lo) > 1e-8:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0 + lbd_mid*theta) != y0:
+        if predict(lbd_mid) != y0:
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
     return lbd_hi, nquery
 
-def fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0):
+def fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0, probe = None):
+    predict = (probe or RayProbe(model, x0)).along(theta)
     nquery = 0
     lbd = initial_lbd
-    while model.predict(x0 + lbd*theta) == y0:
+    while predict(lbd) == y0:
         lbd *= 2.0
         nquery += 1
 
@@ -140,7 +225,7 @@ def fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0):
     lbd_hi_index = 0
     for i, lbd in enumerate(lambdas):
         nquery += 1
-        if model.predict(x0 + lbd*theta) != y0:
+        if predict(lbd) != y0:
             lbd_hi = lbd
             lbd_hi_index = i
             break
@@ -150,26 +235,24 @@ def fine_grained_binary_search(model, x0, y0, theta, initial_lbd = 1.0):
     while (lbd_hi - lbd_lo) > 1e-7:
         lbd_mid = (lbd_lo + lbd_hi)/2.0
         nquery += 1
-        if model.predict(x0 + lbd_mid*theta) != y0:
+        if predict(lbd_mid) != y0:
             lbd_hi = lbd_mid
         else:
             lbd_lo = lbd_mid
     return lbd_hi, nquery
 
 
-def boundary_attack_mnist():
+def boundary_attack_mnist(num_proposals = 1, budget = None, device = None, num_threads = None):
     train_loader, test_loader, train_dataset, test_dataset = load_mnist_data()
-    net = MNIST()
-    if torch.cuda.is_available():
-        net.cuda()
-        net = torch.nn.DataParallel(net, device_ids=[0])
-        #net = torch.nn.DataParallel(net, device_ids=range(torch.cuda.device_count()))
+    policy = DevicePolicy(device, num_threads = num_threads)
+    net = policy.module(MNIST())
         
     load_model(net, 'models/mnist_gpu.pt')
     #load_model(net, 'models/mnist.pt')
     net.eval()
 
-    model = net.module if torch.cuda.is_available() else net
+    model = unwrap(net)
+    model.policy = policy
 
     num_images = 50
 
@@ -185,7 +268,7 @@ def boundary_attack_mnist():
         print("Original label: ", label)
         print("Predicted label: ", model.predict(image))
         
-        adversarial = attack_untargeted(model, train_dataset, image, label, alpha = alpha, beta = beta)
+        adversarial = attack_untargeted(model, train_dataset, image, label, alpha = alpha, beta = beta, num_proposals = num_proposals, budget = budget)
         show_image(adversarial.numpy())
         print("Predicted label for adversarial example: ", model.predict(adversarial))
         distortion_fixsample += torch.norm(adversarial - image)
@@ -0,0 +1,158 @@
+""" K-ary (multi-section) search for the decision boundary along a direction.
+
+    Instead of halving [lbd_lo, lbd_hi] with one query per round, every round
+    classifies k evenly spaced interior points with one predict_batch and keeps
+    the sub-interval around the first adversarial point, so the bracket shrinks
+    by a factor k+1 per round trip. With k=1 this is plain bisection.
+
+    The searches are generators, like those of blackbox_attack: every round
+    yields its k points (built by the attack's RayProbe) and receives their
+    labels back.
+"""
+import time
+import math
+import torch
+
+
+def classify(probe, theta, lbds, is_adv):
+    """ is_adv for x0 + lbd*theta for every lbd in lbds, asked as one batch """
+    predicted = yield probe.points(theta, torch.DoubleTensor(lbds).float())
+    return [bool(a) for a in is_adv(predicted).cpu().tolist()]
+
+
+def kary_bisect(probe, theta, is_adv, lbd_lo, lbd_hi, tol=1e-5, k=8):
+    """ Shrink [lbd_lo, lbd_hi] (lo benign, hi adversarial) to width tol """
+    nquery = 0
+    while (lbd_hi - lbd_lo) > tol:
+        # never ask for more points than needed to reach tol in this round
+        n = max(1, min(k, int(math.ceil((lbd_hi - lbd_lo)/tol)) - 1))
+        step = (lbd_hi - lbd_lo)/(n + 1)
+        lbds = [lbd_lo + step*(j+1) for j in range(n)]
+        adv = yield from classify(probe, theta, lbds, is_adv)
+        nquery += n
+        first = adv.index(True) if True in adv else n
+        if first < n:
+            lbd_hi = lbds[first]
+        if first > 0:
+            lbd_lo = lbds[first-1]
+    return lbd_hi, nquery
+
+
+def local_search(probe, theta, is_adv, initial_lbd = 1.0, tol=1e-5, max_lbd = 20, k=8):
+    """ K-ary counterpart of fine_grained_binary_search_local(_targeted)
+        The bracket around initial_lbd is found with geometric ladders of k
+        points (factors 0.99 and 1.01, as in the scalar search) per round.
+    """
+    nquery = 0
+    lbd = float(initial_lbd)
+    lbds = [lbd * 0.99**j for j in range(k//2, 0, -1)] + [lbd * 1.01**j for j in range(k - k//2)]
+    adv = yield from classify(probe, theta, lbds, is_adv)
+    nquery += k
+
+    if adv[0]:
+        lbd_hi = lbds[0]
+        while True:
+            lbds = [lbd_hi * 0.99**(j+1) for j in range(k)]
+            adv = yield from classify(probe, theta, lbds, is_adv)
+            nquery += k
+            if False in adv:
+                first = adv.index(False)
+                lbd_lo = lbds[first]
+                if first > 0:
+                    lbd_hi = lbds[first-1]
+                break
+            lbd_hi = lbds[-1]
+    elif True in adv:
+        first = adv.index(True)
+        lbd_lo, lbd_hi = lbds[first-1], lbds[first]
+    else:
+        lbd_lo = lbds[-1]
+        while True:
+            if lbd_lo > max_lbd:
+                return float('inf'), nquery
+            lbds = [lbd_lo * 1.01**(j+1) for j in range(k)]
+            adv = yield from classify(probe, theta, lbds, is_adv)
+            nquery += k
+            if True in adv:
+                first = adv.index(True)
+                lbd_hi = lbds[first]
+                if first > 0:
+                    lbd_lo = lbds[first-1]
+                break
+            lbd_lo = lbds[-1]
+
+    lbd_hi, count = yield from kary_bisect(probe, theta, is_adv, lbd_lo, lbd_hi, tol, k)
+    return lbd_hi, nquery + count
+
+
+def initial_search(probe, theta, is_adv, initial_lbd, current_best, tol=1e-5, k=8):
+    """ K-ary counterpart of fine_grained_binary_search """
+    nquery = 0
+    if initial_lbd > current_best:
+        nquery += 1
+        if not (yield from classify(probe, theta, [current_best], is_adv))[0]:
+            return float('inf'), nquery
+        lbd = current_best
+    else:
+        lbd = initial_lbd
+
+    lbd_hi, count = yield from kary_bisect(probe, theta, is_adv, 0.0, float(lbd), tol, k)
+    return lbd_hi, nquery + count
+
+
+def initial_search_targeted(probe, theta, is_adv, initial_lbd = 1.0, tol=1e-7, max_lbd = 100, k=8, num_intervals = 100):
+    """ K-ary counterpart of fine_grained_binary_search_targeted
+        As in the scalar search, the first crossing is then located on a grid
+        of num_intervals-1 points in (0, lbd_hi], k points per round, so a
+        targeted ray that enters and leaves the target class keeps the same
+        boundary as with k=1.
+    """
+    nquery = 0
+    lbd_hi = None
+    lbd = float(initial_lbd)
+    while lbd_hi is None:
+        lbds = [lbd * 1.05**j for j in range(k)]
+        adv = yield from classify(probe, theta, lbds, is_adv)
+        nquery += k
+        if True in adv:
+            lbd_hi = lbds[adv.index(True)]
+        elif lbds[-1] > max_lbd:
+            return float('inf'), nquery
+        else:
+            lbd = lbds[-1] * 1.05
+
+    lambdas = [lbd_hi * j / (num_intervals - 1) for j in range(1, num_intervals)]
+    first = len(lambdas) - 1
+    for start in range(0, len(lambdas), k):
+        adv = yield from classify(probe, theta, lambdas[start:start+k], is_adv)
+        nquery += len(adv)
+        if True in adv:
+            first = start + adv.index(True)
+            break
+    if first == 0:
+        # the scalar search does not bisect below the first grid point either
+        return lambdas[0], nquery
+
+    lbd_hi, count = yield from kary_bisect(probe, theta, is_adv, lambdas[first-1], lambdas[first], tol, k)
+    return lbd_hi, nquery + count
+
+
+def batch_cost(model, x0, sizes = (1, 2, 4, 8, 16, 32, 64), repeats = 5):
+    """ Average seconds per predict_batch call for each batch size """
+    cost = {}
+    for n in sizes:
+        images = x0.unsqueeze(0).repeat(*((n,) + (1,) * x0.dim()))
+        model.predict_batch(images).cpu()
+        timestart = time.time()
+        for _ in range(repeats):
+            model.predict_batch(images).cpu()
+        cost[n] = (time.time() - timestart)/repeats
+    return cost
+
+
+def choose_k(model, x0, sizes = (1, 2, 4, 8, 16, 32, 64), repeats = 5):
+    """ Pick k that shrinks the bracket fastest per second on this model:
+        a round with k points gains log2(k+1) bits and costs one batch of k.
+    """
+    cost = batch_cost(model, x0, sizes, repeats)
+    return max(sizes, key=lambda n: math.log(n+1, 2)/max(cost[n], 1e-9))
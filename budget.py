@@ -0,0 +1,90 @@
+""" Query, time and progress budgets of the attacks.
+
+    Every attack accepts budget=Budget(...) and checks it once per iteration of
+    its main loop (and per candidate of STEP I) with the queries spent so far
+    and its current objective: the distortion for the hard-label attacks, the
+    loss for ZOO (hard_label=False). Once the budget runs out the attack stops
+    and returns the best adversarial example it has found. An iteration is
+    never interrupted, so an attack can overshoot max_queries by the queries
+    of one iteration.
+
+    With epsilon the budget answers "is there an adversarial example within
+    distortion epsilon?" instead, for the hard-label attacks: the attack stops
+    as soon as its distortion reaches epsilon, and gives up once the
+    distortion, extrapolated linearly from its drop over the last window
+    checks, would still be above epsilon when max_queries are spent. The
+    extrapolation is optimistic for the flattening curves of these attacks,
+    so it only gives up on hopeless images.
+"""
+import time
+
+
+class Budget(object):
+    """ Stopping rule of an attack
+        max_queries: model queries the attack may spend, STEP I included
+        max_seconds: wall-clock seconds since the attack started
+        patience: iterations without the objective dropping by a factor
+                  min_improvement after which the attack has converged
+        epsilon: distortion at which the attack has succeeded (hard-label
+                 attacks only, the ZOO objective is a loss)
+        window: checks the give-up extrapolation looks back over
+    """
+    def __init__(self, max_queries=None, max_seconds=None, patience=None, min_improvement=0.001, epsilon=None, window=10):
+        self.max_queries = max_queries
+        self.max_seconds = max_seconds
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.epsilon = epsilon
+        self.window = window
+        self.start()
+
+    def start(self):
+        """ Restart the clock and the plateau counter, at the beginning of an attack """
+        self.timestart = time.time()
+        self.best = float('inf')
+        self.stall = 0
+        self.history = []
+        self.reason = None
+        return self
+
+    def reached(self, objective):
+        """ True if objective is within epsilon, the attack succeeded """
+        if self.epsilon is not None and objective <= self.epsilon:
+            self.reason = "distortion %.4f within epsilon %.4f" % (objective, self.epsilon)
+        return self.reason is not None
+
+    def hopeless(self, queries, objective):
+        """ True if objective cannot reach epsilon within max_queries at its recent rate """
+        if self.epsilon is None or self.max_queries is None:
+            return False
+        self.history.append((queries, objective))
+        if len(self.history) <= self.window:
+            return False
+        past_queries, past_objective = self.history[-1-self.window]
+        rate = (past_objective - objective) / max(queries - past_queries, 1)
+        projected = objective - rate * (self.max_queries - queries)
+        if projected > self.epsilon:
+            self.reason = "epsilon %.4f out of reach, distortion %.4f projected at %d queries" % (self.epsilon, projected, self.max_queries)
+        return self.reason is not None
+
+    def exhausted(self, queries, objective=None, hard_label=True):
+        """ True once the attack should stop, with the cause in self.reason
+            objective: counts towards the plateau when given
+            hard_label: objective is a distortion and is checked against
+                        epsilon; False for a loss such as ZOO's
+        """
+        if objective is not None and hard_label and (self.reached(objective) or self.hopeless(queries, objective)):
+            return True
+        if self.max_queries is not None and queries >= self.max_queries:
+            self.reason = "query budget of %d spent" % self.max_queries
+        elif self.max_seconds is not None and time.time() - self.timestart >= self.max_seconds:
+            self.reason = "time budget of %.1f seconds spent" % self.max_seconds
+        elif self.patience is not None and objective is not None:
+            if objective < self.best * (1 - self.min_improvement):
+                self.best = objective
+                self.stall = 0
+            else:
+                self.stall += 1
+                if self.stall >= self.patience:
+                    self.reason = "no progress in %d iterations" % self.patience
+        return self.reason is not None
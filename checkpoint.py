@@ -0,0 +1,82 @@
+""" Checkpoints of long-running attacks.
+
+    An attack periodically saves its optimizer state (theta, g2, alpha, beta,
+    query counts, iteration) together with the python, numpy and torch random
+    states, so that a resumed attack draws the same directions it would have
+    drawn without the interruption. RunProgress records the distortion of every
+    finished image of a run so a restarted driver skips them. Files are
+    written to a temporary name and renamed, so a checkpoint is never half
+    written.
+"""
+import os
+import pickle
+import random
+import numpy as np
+import torch
+
+
+def rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+
+
+def save_checkpoint(filename, state):
+    """ Atomically save state (a dict of cpu tensors and numbers) with the current RNG states """
+    state = dict(state, rng = rng_state())
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
+
+
+def load_checkpoint(filename):
+    """ State saved by save_checkpoint, None if there is none
+        The caller restores state['rng'] with set_rng_state where the attack resumes.
+    """
+    if filename is None or not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def clear_checkpoint(filename):
+    if filename is not None and os.path.exists(filename):
+        os.remove(filename)
+
+
+class RunProgress(object):
+    """ Distortions of the finished images of a run and the RNG states after the
+        last one, so a resumed driver skips the finished images and continues
+        with the random numbers it would have drawn next
+        resume: load an existing progress file (otherwise start over)
+    """
+    def __init__(self, filename, resume = True):
+        self.filename = filename
+        self.done = {}
+        state = load_checkpoint(filename) if resume else None
+        if state is not None:
+            self.done = state['done']
+            set_rng_state(state['rng'])
+            print("Resuming run: %d images already attacked" % len(self.done))
+
+    def __contains__(self, idx):
+        return idx in self.done
+
+    def __getitem__(self, idx):
+        return self.done[idx]
+
+    def record(self, idx, distortion):
+        self.done[idx] = float(distortion)
+        save_checkpoint(self.filename, {'done': self.done})
+
+    def checkpoint(self, idx):
+        """ Checkpoint file of the attack on image idx, next to the progress file """
+        return os.path.splitext(self.filename)[0] + '-%d.ckpt' % idx
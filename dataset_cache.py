@@ -0,0 +1,226 @@
+""" uint8 memory-mapped copies of the MNIST, CIFAR10 and ImageNet sets.
+
+    Each set is decoded once into .npy images and labels that later runs
+    memory-map; ImageNet is cropped into shards and only normalized on read.
+"""
+import os
+import json
+import multiprocessing
+import numpy as np
+import torch
+import torchvision.datasets as dsets
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.utils.data.dataset import Dataset
+
+imagenet_mean = torch.FloatTensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+imagenet_std = torch.FloatTensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+
+def to_float(images):
+    """ uint8 array -> float tensor in [0, 1], as ToTensor computes it """
+    if not images.flags.writeable:
+        # slices of the read-only memmap; fancy-indexed batches are copies already
+        images = np.array(images)
+    return torch.from_numpy(images).float().div_(255)
+
+
+def convert_dataset(dataset, prefix, batch_size=1000):
+    """ Write dataset (float images in [0, 1]) to prefix-images.npy and prefix-labels.npy """
+    image, _ = dataset[0]
+    shape = (len(dataset),) + tuple(image.size())
+    images = np.lib.format.open_memmap(prefix + '-images.tmp.npy', mode='w+', dtype=np.uint8, shape=shape)
+    labels = np.lib.format.open_memmap(prefix + '-labels.tmp.npy', mode='w+', dtype=np.int64, shape=(len(dataset),))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    start = 0
+    for xi, yi in loader:
+        images[start:start+xi.size(0)] = xi.mul(255).round().byte().numpy()
+        labels[start:start+xi.size(0)] = np.asarray(yi)
+        start += xi.size(0)
+    images.flush()
+    labels.flush()
+    del images, labels
+    # the images file is renamed last: its presence marks a complete cache
+    os.rename(prefix + '-labels.tmp.npy', prefix + '-labels.npy')
+    os.rename(prefix + '-images.tmp.npy', prefix + '-images.npy')
+
+
+class MemmapDataset(Dataset):
+    """ Images and labels memory-mapped from the files written by convert_dataset
+        dataset[i] is (float image, int label) like the torchvision datasets.
+        Pickling keeps only the file prefix, so worker processes reopen the
+        files and share their pages instead of receiving a copy.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.images = np.load(prefix + '-images.npy', mmap_mode='r')
+        self.labels = np.load(prefix + '-labels.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return to_float(self.images[idx]), int(self.labels[idx])
+
+    def batch(self, indices):
+        """ (images, labels) tensors of the images at indices (an array or a slice) """
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices)
+        return to_float(self.images[indices]), torch.from_numpy(np.array(self.labels[indices]))
+
+    def loader(self, batch_size, shuffle=False):
+        return BatchLoader(self, batch_size, shuffle)
+
+    def __getstate__(self):
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state['prefix'])
+
+
+class BatchLoader(object):
+    """ DataLoader replacement drawing whole batches from a MemmapDataset """
+    def __init__(self, dataset, batch_size, shuffle=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(n).numpy()
+            for start in range(0, n, self.batch_size):
+                yield self.dataset.batch(order[start:start+self.batch_size])
+        else:
+            for start in range(0, n, self.batch_size):
+                yield self.dataset.batch(slice(start, start+self.batch_size))
+
+
+def cached_dataset(name, build, cache_dir='data/memmap'):
+    """ MemmapDataset of name, converting build() (a torchvision dataset) on first use """
+    prefix = os.path.join(cache_dir, name)
+    if not os.path.exists(prefix + '-images.npy'):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        dataset = build()
+        print("Converting %s (%d images) to %s-images.npy" % (name, len(dataset), prefix))
+        convert_dataset(dataset, prefix)
+    return MemmapDataset(prefix)
+
+
+def imagenet_files(root):
+    """ (path, label) of the images under root: class folders as read by
+        ImageFolder (/data/val), or a flat folder of <label+1>.<ext> files as
+        read by ImagenetTestDataset (/data/test)
+    """
+    names = sorted(os.listdir(root))
+    if any(os.path.isdir(os.path.join(root, name)) for name in names):
+        return list(dsets.ImageFolder(root).imgs)
+    return [(os.path.join(root, name), int(name.split('.')[0])-1) for name in names]
+
+
+def decode_crop(path, size=256, crop=224):
+    """ uint8 (3, crop, crop) array of the image at path after Resize(size) and CenterCrop(crop) """
+    image = Image.open(path).convert('RGB')
+    image = transforms.CenterCrop(crop)(transforms.Resize(size)(image))
+    return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)
+
+
+def _close_shard(shard, prefix, k):
+    shard.flush()
+    os.rename('%s-%d.tmp.npy' % (prefix, k), '%s-%d.npy' % (prefix, k))
+
+
+def decode_imagenet(root, prefix, num_workers=None, shard_size=5000, chunksize=16):
+    """ Decode the images under root with num_workers processes into the shards
+        prefix-<k>.npy and the index prefix-index.json
+    """
+    files = imagenet_files(root)
+    pool = multiprocessing.Pool(num_workers or multiprocessing.cpu_count())
+    finished = False
+    try:
+        shard = None
+        for i, crop in enumerate(pool.imap(decode_crop, [path for path, _ in files], chunksize)):
+            k, j = divmod(i, shard_size)
+            if j == 0:
+                if shard is not None:
+                    _close_shard(shard, prefix, k-1)
+                shape = (min(shard_size, len(files) - i),) + crop.shape
+                shard = np.lib.format.open_memmap('%s-%d.tmp.npy' % (prefix, k), mode='w+', dtype=np.uint8, shape=shape)
+            shard[j] = crop
+            if (i+1) % 1000 == 0:
+                print("Decoded %d/%d images" % (i+1, len(files)))
+        if shard is not None:
+            _close_shard(shard, prefix, (len(files)-1) // shard_size)
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+    # the index is written last: its presence marks a complete cache
+    index = {'root': root, 'shard_size': shard_size, 'paths': [path for path, _ in files], 'labels': [label for _, label in files]}
+    with open(prefix + '-index.tmp.json', 'w') as f:
+        json.dump(index, f)
+    os.rename(prefix + '-index.tmp.json', prefix + '-index.json')
+
+
+class ImagenetCache(Dataset):
+    """ Normalized 224x224 ImageNet images read from the shards of decode_imagenet
+        dataset[i] equals ImageFolder/ImagenetTestDataset[i] with the Resize(256),
+        CenterCrop(224), ToTensor, Normalize transform of models.py.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + '-index.json') as f:
+            index = json.load(f)
+        self.shard_size = index['shard_size']
+        self.labels = np.array(index['labels'], dtype=np.int64)
+        num_shards = (len(self.labels) + self.shard_size - 1) // self.shard_size
+        self.shards = [np.load('%s-%d.npy' % (prefix, k), mmap_mode='r') for k in range(num_shards)]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def normalize(self, images):
+        return to_float(images).sub_(imagenet_mean).div_(imagenet_std)
+
+    def __getitem__(self, idx):
+        k, j = divmod(idx, self.shard_size)
+        return self.normalize(self.shards[k][j]), int(self.labels[idx])
+
+    def batch(self, indices):
+        """ (images, labels) tensors of the images at indices (an array or a slice) """
+        if isinstance(indices, slice):
+            indices = np.arange(*indices.indices(len(self)))
+        indices = np.asarray(indices)
+        k, j = np.divmod(indices, self.shard_size)
+        images = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=np.uint8)
+        for shard in np.unique(k):
+            rows = k == shard
+            images[rows] = self.shards[shard][j[rows]]
+        return self.normalize(images), torch.from_numpy(self.labels[indices])
+
+    def loader(self, batch_size, shuffle=False):
+        return BatchLoader(self, batch_size, shuffle)
+
+    def __getstate__(self):
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state['prefix'])
+
+
+def cached_imagenet(name, root, cache_dir='data/memmap', num_workers=None):
+    """ ImagenetCache of name, decoding the images under root on first use """
+    prefix = os.path.join(cache_dir, name)
+    if not os.path.exists(prefix + '-index.json'):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        print("Decoding %s into %s-<shard>.npy" % (root, prefix))
+        decode_imagenet(root, prefix, num_workers)
+    return ImagenetCache(prefix)
@@ -0,0 +1,50 @@
+""" Lockstep driver of the OPT attacks in blackbox_attack.py.
+
+    attack_untargeted_steps and attack_targeted_steps are generators that yield
+    every batch of images they want classified and receive the predicted labels
+    back through send(); the adversarial example is the generator's return
+    value. Since the attacks never call the model themselves, run_lockstep can
+    advance any number of them together and answer all their pending batches
+    with one predict_batch per step. Give every attack a seed so that its
+    samples and directions do not depend on the attacks it runs with.
+"""
+import torch
+from oracle import predict_points
+
+
+def run_lockstep(model, attacks, max_batch_size = 1024):
+    """ Drive many attack generators together. At each step the pending batches
+        of every live attack are answered with predict_batch (chunked to
+        max_batch_size). A label right at the boundary can come out differently
+        in a larger batch, so an attack may end a little away from its
+        synchronous run.
+        model: object with predict_batch
+        attacks: list of generators from blackbox_attack.attack_untargeted_steps
+                 / attack_targeted_steps (or their searches), all on model
+        output: list of the attacks' return values in the order of attacks
+    """
+    results = [None] * len(attacks)
+    pending = {}
+    for i, attack in enumerate(attacks):
+        try:
+            pending[i] = next(attack)
+        except StopIteration as e:
+            results[i] = e.value
+
+    while pending:
+        index = list(pending.keys())
+        # the batches live in the attacks' probe buffers, copied here before
+        # any attack is resumed
+        images = torch.cat([pending[i] for i in index])
+        labels = torch.cat([predict_points(model, images[start:start+max_batch_size])
+                            for start in range(0, images.size(0), max_batch_size)])
+        start = 0
+        for i in index:
+            n = pending[i].size(0)
+            try:
+                pending[i] = attacks[i].send(labels[start:start+n])
+            except StopIteration as e:
+                results[i] = e.value
+                del pending[i]
+            start += n
+    return results
@@ -1,3 +1,4 @@
+import sys
 import time
 import random 
 import numpy as np
@@ -12,32 +13,116 @@ from PIL import Image
 #import pretrainedmodels
 #import pretrainedmodels.utils as utils
 import torchvision.models as models
+from dataset_cache import cached_dataset, cached_imagenet
 
 # Hyperparameters
 num_epochs = 50
 batch_size = 128
 learning_rate = 0.001
 
+class DevicePolicy(object):
+    """ Where and in which precision the models and attacks run
+        device: 'cuda' or 'cpu', 'cuda' when available if None
+        dtype: 'float' or 'double', type of the images fed to the model
+        num_threads: intra-op threads for torch on cpu (torch default if None),
+                     set with torch.set_num_threads when the policy is created
+    """
+    def __init__(self, device=None, dtype='float', num_threads=None):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = device
+        self.dtype = dtype
+        self.num_threads = num_threads
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    @property
+    def is_cuda(self):
+        return self.device == 'cuda'
+
+    def tensor(self, x):
+        """ x on the policy's device, copied only if it is elsewhere, and contiguous """
+        if self.is_cuda and not x.is_cuda:
+            x = x.cuda()
+        elif not self.is_cuda and x.is_cuda:
+            x = x.cpu()
+        return x.contiguous()
+
+    def pin(self, x):
+        """ x in page-locked memory on cuda, so that its copies to the device
+            are asynchronous; the attacks' own arithmetic stays on the cpu
+        """
+        return x.pin_memory() if self.is_cuda else x
+
+    def images(self, x):
+        """ tensor(x) cast to the policy's dtype """
+        x = self.tensor(x)
+        return x.double() if self.dtype == 'double' else x.float()
+
+    def clamp(self, x, bounds, clamped=False):
+        """ images(x) clamped to bounds
+            clamped: x is already within bounds (the points of a RayProbe) and
+                     is passed through without a copy
+        """
+        x = self.images(x)
+        return x if clamped else torch.clamp(x, bounds[0], bounds[1])
+
+    def module(self, net):
+        """ net cast to dtype and moved to the device, in DataParallel on cuda """
+        net = net.double() if self.dtype == 'double' else net.float()
+        if self.is_cuda:
+            net = torch.nn.DataParallel(net.cuda(), device_ids=[0])
+        return net
+
+default_policy = DevicePolicy()
+
+def policy_of(model):
+    """ DevicePolicy of a model, or of the model behind a wrapper """
+    return getattr(model, 'policy', default_policy)
+
+def unwrap(net):
+    """ The model inside DataParallel, or net itself """
+    return net.module if isinstance(net, nn.DataParallel) else net
+
+def pretrained_checkpoint(arch):
+    """ File the pretrained torchvision weights of arch were downloaded to, or
+        None if it cannot be found (the caches then hash the weights instead)
+    """
+    url = getattr(sys.modules[models.__dict__[arch].__module__], 'model_urls', {}).get(arch)
+    if url is None and hasattr(models, 'get_model_weights'):
+        url = models.get_model_weights(arch).DEFAULT.url
+    if url is None:
+        return None
+    dirs = [os.environ.get('TORCH_MODEL_ZOO', os.path.join(os.path.expanduser('~'), '.torch', 'models'))]
+    if hasattr(torch, 'hub'):
+        dirs.append(os.path.join(torch.hub.get_dir(), 'checkpoints'))
+    for d in dirs:
+        filename = os.path.join(d, os.path.basename(url))
+        if os.path.exists(filename):
+            return filename
+    return None
+
 class IMAGENET():
-    def __init__(self, arch):
+    bounds = (-1, 1)
+
+    def __init__(self, arch, policy=None):
+        self.policy = policy or default_policy
         self.model = models.__dict__[arch](pretrained=True)
         self.model.eval()
-        if torch.cuda.is_available():
-            self.model = self.model.cuda()
-            self.model = torch.nn.DataParallel(self.model, device_ids=[0])
+        self.model = self.policy.module(self.model)
+        # weights file the prediction index and decision cache are keyed by
+        self.checkpoint = pretrained_checkpoint(arch)
  
-    def predict(self, image):
-        image = torch.clamp(image, -1, 1)
+    def predict(self, image, clamped=False):
+        image = self.policy.clamp(image, self.bounds, clamped)
         image = Variable(image, volatile=True).view(1,3,224,224)
         output = self.model(image)
         _, predict = torch.max(output.data, 1)
         return predict[0]
     
-    def predict_batch(self, image):
-        image = torch.clamp(image, -1 ,1)
+    def predict_batch(self, image, clamped=False):
+        image = self.policy.clamp(image, self.bounds, clamped)
         image = Variable(image, volatile=True)
-        if torch.cuda.is_available():
-            image = image.cuda()
         output = self.model(image)
         _, predict = torch.max(output.data, 1)
         return predict
@@ -45,6 +130,9 @@ class IMAGENET():
 
 
 class CIFAR10(nn.Module):
+    policy = default_policy
+    bounds = (0, 1)
+
     def __init__(self):
         super(CIFAR10, self).__init__()
         self.features = self._make_layers()
@@ -87,22 +175,18 @@ class CIFAR10(nn.Module):
         return nn.Sequential(*layers)
 
 
-    def predict(self, image):
+    def predict(self, image, clamped=False):
         self.eval()
-        image = torch.clamp(image,0,1)
+        image = self.policy.clamp(image, self.bounds, clamped)
         image = Variable(image, volatile=True).view(1,3, 32,32)
-        if torch.cuda.is_available():
-            image = image.cuda()
         output = self(image)
         _, predict = torch.max(output.data, 1)
         return predict[0]
     
-    def predict_batch(self, image):
+    def predict_batch(self, image, clamped=False):
         self.eval()
-        image = torch.clamp(image,0,1)
+        image = self.policy.clamp(image, self.bounds, clamped)
         image = Variable(image, volatile=True)
-        if torch.cuda.is_available():
-            image = image.cuda()
         output = self(image)
         _, predict = torch.max(output.data, 1)
         return predict
@@ -110,6 +194,9 @@ class CIFAR10(nn.Module):
 
 
 class MNIST(nn.Module):
+    policy = default_policy
+    bounds = (0, 1)
+
     def __init__(self):
         super(MNIST, self).__init__()
         self.features = self._make_layers()
@@ -152,22 +239,18 @@ class MNIST(nn.Module):
         return nn.Sequential(*layers)
 
 
-    def predict(self, image):
+    def predict(self, image, clamped=False):
         self.eval()
-        image = torch.clamp(image,0,1)
+        image = self.policy.clamp(image, self.bounds, clamped)
         image = Variable(image, volatile=True).view(1,1,28,28)
-        if torch.cuda.is_available():
-            image = image.cuda()
         output = self(image)
         _, predict = torch.max(output.data, 1)
         return predict[0]
 
-    def predict_batch(self, image):
+    def predict_batch(self, image, clamped=False):
         self.eval()
-        image = torch.clamp(image,0,1)
+        image = self.policy.clamp(image, self.bounds, clamped)
         image = Variable(image, volatile=True)
-        if torch.cuda.is_available():
-            image = image.cuda()
         output = self(image)
         _, predict = torch.max(output.data, 1)
         return predict
@@ -222,42 +305,44 @@ def show_image(img):
     for i in range(28):
         print("".join([remap[int(round(x))] for x in img[i*28:i*28+28]]))
 
-def load_mnist_data():
+def load_mnist_data(cache_dir='data/memmap'):
     """ Load MNIST data from torchvision.datasets 
         input: None
         output: minibatches of train and test sets 
+        The sets are converted once to uint8 memmaps in cache_dir (see dataset_cache).
     """
     # MNIST Dataset
-    train_dataset = dsets.MNIST(root='./data/mnist', train=True, transform=transforms.ToTensor(), download=True)
-    test_dataset = dsets.MNIST(root='./data/mnist', train=False, transform=transforms.ToTensor())
+    train_dataset = cached_dataset('mnist-train', lambda: dsets.MNIST(root='./data/mnist', train=True, transform=transforms.ToTensor(), download=True), cache_dir)
+    test_dataset = cached_dataset('mnist-test', lambda: dsets.MNIST(root='./data/mnist', train=False, transform=transforms.ToTensor(), download=True), cache_dir)
 
     # Data Loader (Input Pipeline)
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=1000, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=10, shuffle=False)
+    train_loader = train_dataset.loader(batch_size=1000, shuffle=True)
+    test_loader = test_dataset.loader(batch_size=10, shuffle=False)
 
     return train_loader, test_loader, train_dataset, test_dataset
 
-def load_cifar10_data():
+def load_cifar10_data(cache_dir='data/memmap'):
     """ Load MNIST data from torchvision.datasets 
         input: None
         output: minibatches of train and test sets 
+        The sets are converted once to uint8 memmaps in cache_dir (see dataset_cache).
     """
     # CIFAR10 Dataset
-    train_dataset = dsets.CIFAR10('./data/cifar10-py', download=True, train=True, transform= transforms.ToTensor())
-    test_dataset = dsets.CIFAR10('./data/cifar10-py', download=True, train=False, transform= transforms.ToTensor())
+    train_dataset = cached_dataset('cifar10-train', lambda: dsets.CIFAR10('./data/cifar10-py', download=True, train=True, transform= transforms.ToTensor()), cache_dir)
+    test_dataset = cached_dataset('cifar10-test', lambda: dsets.CIFAR10('./data/cifar10-py', download=True, train=False, transform= transforms.ToTensor()), cache_dir)
 
     # Data Loader (Input Pipeline)
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=1000, shuffle=False)
-    test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=10, shuffle=False)
+    train_loader = train_dataset.loader(batch_size=1000, shuffle=False)
+    test_loader = test_dataset.loader(batch_size=10, shuffle=False)
 
     return train_loader, test_loader, train_dataset, test_dataset
 
-def load_imagenet_data():
+def load_imagenet_data(cache_dir='data/memmap'):
     """ Load MNIST data from torchvision.datasets 
         input: None
         output: minibatches of train and test sets 
+        The crops are decoded once into a sharded uint8 cache in cache_dir (see dataset_cache).
     """
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])                         
     # train_dataset = dsets.ImageFolder(
     #     '/data/train',
     #     transforms.Compose([
@@ -266,17 +351,10 @@ def load_imagenet_data():
     #         transforms.ToTensor(),
     #         normalize,
     #     ]))
-    val_dataset = dsets.ImageFolder(
-        '/data/val',
-        transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ]))
+    val_dataset = cached_imagenet('imagenet-val', '/data/val', cache_dir)
 
     # Data Loader (Input Pipeline)
-    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=1000, shuffle=True)
+    val_loader = val_dataset.loader(batch_size=1000, shuffle=True)
 
     return val_loader, val_loader, val_dataset, val_dataset
 
@@ -303,14 +381,14 @@ class ImagenetTestDataset(Dataset):
     def __len__(self):
         return len(self.label)
 
-def imagenettest():
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]) 
+def imagenettest(cache_dir='data/memmap'):
     #test_dataset = ImagenetTestDataset('/data/test')
 
-    test_dataset = ImagenetTestDataset('/data/test', transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(), normalize,]))
+    #test_dataset = ImagenetTestDataset('/data/test', transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(), normalize,]))
+    test_dataset = cached_imagenet('imagenet-test', '/data/test', cache_dir)
 
     # Data Loader (Input Pipeline)
-    test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=10, shuffle=True)
+    test_loader = test_dataset.loader(batch_size=10, shuffle=True)
 
     return test_loader, test_dataset
 
@@ -453,8 +531,19 @@ def save_model(model, filename):
     torch.save(model.state_dict(), filename)
 
 def load_model(model, filename):
-    """ Load the training model """
-    model.load_state_dict(torch.load(filename))
+    """ Load the training model, on any device and with or without DataParallel
+        ('module.' key prefix) on either side
+    """
+    state = torch.load(filename, map_location=lambda storage, loc: storage)
+    wrapped = isinstance(model, nn.DataParallel)
+    fixed = {}
+    for key, value in state.items():
+        if key.startswith('module.') and not wrapped:
+            key = key[len('module.'):]
+        elif wrapped and not key.startswith('module.'):
+            key = 'module.' + key
+        fixed[key] = value
+    model.load_state_dict(fixed)
 
 if __name__ == '__main__':
     train_loader, test_loader, train_dataset, test_dataset = load_mnist_data()
@@ -0,0 +1,173 @@
+""" Nearest-neighbour index over training images for STEP I.
+
+    Instead of bisecting along xi - x0 for hundreds of random training images,
+    STEP I can start from the few training images of the wrong (or target)
+    class that are closest to x0 in L2, which usually give the smallest
+    starting g_theta. NeighborIndex is exact (one BLAS matrix-vector product
+    per query); IVFIndex clusters the images with k-means and only scans the
+    nprobe closest clusters.
+"""
+import os
+import numpy as np
+import torch
+
+
+def dataset_features(dataset, batch_size = 1000, filename = None):
+    """ Training images flattened into an (N, D) float32 array, with their labels
+        The batches are written into the array as they are decoded, a .npy
+        memmap at filename if given, so the set is never held twice.
+    """
+    image, _ = dataset[0]
+    shape = (len(dataset), image.numel())
+    if filename is not None:
+        features = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=shape)
+    else:
+        features = np.empty(shape, dtype=np.float32)
+    labels = np.empty(len(dataset), dtype=np.int64)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    start = 0
+    for images, y in loader:
+        features[start:start+images.size(0)] = images.view(images.size(0), -1).numpy()
+        labels[start:start+images.size(0)] = np.asarray(y)
+        start += images.size(0)
+    if filename is not None:
+        features.flush()
+    return features, labels
+
+
+class NeighborIndex(object):
+    """ Exact L2 nearest neighbours
+        features: (N, D) float32 images
+        labels: (N,) labels used to filter candidates; pass the model's predictions
+                (PredictionIndex.labels) and predicted=True so STEP I can skip
+                checking each candidate with a query
+    """
+    def __init__(self, features, labels, predicted = False):
+        self.features = features
+        self.labels = np.asarray(labels)
+        self.predicted = predicted
+        self.sq_norms = np.einsum('ij,ij->i', features, features)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _mask(self, label, exclude):
+        if label is not None:
+            return self.labels == label
+        if exclude is not None:
+            return self.labels != exclude
+        return np.ones(len(self.labels), dtype=bool)
+
+    def _nearest(self, index, q, k):
+        """ k nearest rows of index to q, sorted by distance """
+        if len(index) == 0:
+            return index, np.zeros(0, dtype=np.float32)
+        dist = self.sq_norms[index] - 2.0 * self.features[index].dot(q) + q.dot(q)
+        k = min(k, len(index))
+        top = np.argpartition(dist, k-1)[:k]
+        top = top[np.argsort(dist[top])]
+        return index[top], np.sqrt(np.maximum(dist[top], 0))
+
+    def search(self, x0, k = 10, label = None, exclude = None):
+        """ Indices and L2 distances of the k training images closest to x0
+            among those with labels == label (or != exclude)
+        """
+        q = x0.contiguous().view(-1).numpy().astype(np.float32)
+        return self._nearest(np.flatnonzero(self._mask(label, exclude)), q, k)
+
+    def save(self, prefix):
+        filename = prefix + '-features.npy'
+        # features streamed there by dataset_features are already saved
+        if getattr(self.features, 'filename', None) != os.path.abspath(filename):
+            np.save(filename, self.features)
+        np.save(prefix + '-labels.npy', self.labels)
+
+    @classmethod
+    def load(cls, prefix, predicted = False):
+        return cls(np.load(prefix + '-features.npy', mmap_mode='r'), np.load(prefix + '-labels.npy'), predicted)
+
+
+def kmeans(features, nlist, iterations = 10, sample_size = 20000, seed = 0):
+    """ Lloyd's k-means on a random subset of features, returns (nlist, D) centroids """
+    rng = np.random.RandomState(seed)
+    sample = features[rng.choice(len(features), min(sample_size, len(features)), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _assign(sample, centroids)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(0)
+    return centroids
+
+
+def _assign(features, centroids, batch_size = 10000):
+    c_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assign = np.empty(len(features), dtype=np.int64)
+    for start in range(0, len(features), batch_size):
+        block = np.asarray(features[start:start+batch_size])
+        assign[start:start+batch_size] = np.argmin(c_norms[None, :] - 2.0 * block.dot(centroids.T), 1)
+    return assign
+
+
+class IVFIndex(NeighborIndex):
+    """ Approximate L2 nearest neighbours with an inverted file
+        The images are split into nlist k-means clusters; a search only scans
+        the nprobe clusters whose centroids are closest to x0.
+    """
+    def __init__(self, features, labels, predicted = False, nlist = 64, nprobe = 8, centroids = None, assign = None):
+        super(IVFIndex, self).__init__(features, labels, predicted)
+        self.nprobe = nprobe
+        self.centroids = centroids if centroids is not None else kmeans(features, nlist)
+        self.assign = assign if assign is not None else _assign(features, self.centroids)
+
+    def search(self, x0, k = 10, label = None, exclude = None):
+        q = x0.contiguous().view(-1).numpy().astype(np.float32)
+        probe = np.argsort(((self.centroids - q[None, :])**2).sum(1))[:self.nprobe]
+        index = np.flatnonzero(np.isin(self.assign, probe) & self._mask(label, exclude))
+        return self._nearest(index, q, k)
+
+    def save(self, prefix):
+        super(IVFIndex, self).save(prefix)
+        np.save(prefix + '-centroids.npy', self.centroids)
+        np.save(prefix + '-assign.npy', self.assign)
+
+    @classmethod
+    def load(cls, prefix, predicted = False, nlist = None, nprobe = 8):
+        """ nlist is fixed by the saved centroids and only accepted for symmetry with __init__
+            The cluster of every image is loaded too, or recomputed once for an
+            index saved without it.
+        """
+        features = np.load(prefix + '-features.npy', mmap_mode='r')
+        centroids = np.load(prefix + '-centroids.npy')
+        assign = np.load(prefix + '-assign.npy') if os.path.exists(prefix + '-assign.npy') else None
+        index = cls(features, np.load(prefix + '-labels.npy'), predicted, len(centroids), nprobe, centroids, assign)
+        if assign is None:
+            np.save(prefix + '-assign.npy', index.assign)
+        return index
+
+
+def build_neighbor_index(dataset, labels = None, approximate = False, prefix = None, **kwargs):
+    """ NeighborIndex (or IVFIndex if approximate) over dataset
+        labels: predicted labels of the model on dataset (e.g. PredictionIndex.labels);
+                the dataset's own labels are used when None
+        prefix: if given, the index is saved there and reloaded on later calls
+        The saved index holds the dataset's labels only: predicted labels are
+        applied after loading, so a cache never passes off stale labels (of
+        another checkpoint, or the true ones) as the model's predictions.
+    """
+    cls = IVFIndex if approximate else NeighborIndex
+    if prefix is not None and approximate:
+        prefix += '-ivf%d' % kwargs.get('nlist', 64)
+    # the labels are saved after the features, so a build cut short is redone
+    if prefix is not None and os.path.exists(prefix + '-labels.npy'):
+        index = cls.load(prefix, **kwargs)
+    else:
+        features, true_labels = dataset_features(dataset, filename = prefix + '-features.npy' if prefix is not None else None)
+        index = cls(features, true_labels, **kwargs)
+        if prefix is not None:
+            index.save(prefix)
+    if labels is not None:
+        index.labels = np.asarray(labels)
+        index.predicted = True
+    return index
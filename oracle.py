@@ -0,0 +1,356 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+import torch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from prediction_index import checkpoint_hash, model_hash
+from models import policy_of
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class _Query(object):
+    def __init__(self, images):
+        self.images = images
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class QueryBatcher(object):
+    """ Hard-label oracle shared by many concurrently running attacks.
+        Single-image queries coming from different threads are gathered into
+        micro-batches of at most max_batch_size images and answered with one
+        model.predict_batch call. A batch is sent as soon as it is full or when
+        the oldest pending query has waited max_wait seconds.
+        model: object with predict_batch (MNIST, CIFAR10, IMAGENET)
+    """
+    def __init__(self, model, max_batch_size=64, max_wait=0.002):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_queries = 0
+        self.num_batches = 0
+        self._pending = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def predict(self, image):
+        """ Same contract as model.predict: one image in, one label out """
+        return self._submit(image.unsqueeze(0))[0]
+
+    def predict_batch(self, image):
+        """ Already batched queries go through the same worker so that the model
+            is only ever called from one thread
+        """
+        return self._submit(image)
+
+    def _submit(self, images):
+        if self._closed:
+            raise RuntimeError("QueryBatcher is closed")
+        query = _Query(images)
+        self._pending.put(query)
+        query.done.wait()
+        if query.error is not None:
+            raise query.error
+        return query.result
+
+    def _collect(self):
+        first = self._pending.get()
+        if first is None:
+            return None
+        batch = [first]
+        size = first.images.size(0)
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                query = self._pending.get(timeout=timeout) if timeout > 0 else self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if query is None:
+                self._pending.put(None)
+                break
+            batch.append(query)
+            size += query.images.size(0)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                images = torch.cat([query.images for query in batch], 0)
+                predicted = self.model.predict_batch(images)
+            except Exception as e:
+                for query in batch:
+                    query.error = e
+                    query.done.set()
+                continue
+            self.num_queries += images.size(0)
+            self.num_batches += 1
+            start = 0
+            for query in batch:
+                end = start + query.images.size(0)
+                query.result = predicted[start:end]
+                query.done.set()
+                start = end
+
+    def stats(self):
+        """ Number of images answered, number of model calls and mean batch size """
+        mean_batch = float(self.num_queries) / self.num_batches if self.num_batches else 0.0
+        return {'queries': self.num_queries, 'batches': self.num_batches, 'mean_batch_size': mean_batch}
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._pending.put(None)
+            self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def predict_points(model, images):
+    """ model.predict_batch of images built by a RayProbe of model, which are
+        already within its bounds and are not clamped again
+    """
+    if getattr(model, 'bounds', None) is None:
+        return model.predict_batch(images)
+    return model.predict_batch(images, clamped=True)
+
+
+class RayProbe(object):
+    """ The points x0 + lbd*theta queried by the boundary searches of one attack,
+        written into buffers allocated once instead of two fresh tensors per
+        query. A point is written as lbd*theta into the buffer, then x0 is added
+        and the result clamped to the model's bounds in place, and predict is
+        told so (clamped=True) to skip its own clamp copy. The rounding is that
+        of x0 + lbd*theta, so the searches take exactly the same steps as with
+        fresh tensors.
+        The buffers are overwritten by the next call: a probe belongs to one
+        attack and its points must not be kept.
+    """
+    def __init__(self, model, x0):
+        self.model = model
+        self.x0 = x0
+        self.bounds = getattr(model, 'bounds', None)
+        self.clamped = {'clamped': True} if self.bounds is not None else {}
+        self.buffer = x0.new(x0.size())
+        self.batch = None
+
+    def _clamp(self, images):
+        if self.bounds is not None:
+            images.clamp_(self.bounds[0], self.bounds[1])
+        return images
+
+    def image(self, x):
+        """ x itself, clamped to the model's bounds, in the probe's buffer """
+        return self._clamp(self.buffer.copy_(x))
+
+    def point(self, theta, lbd):
+        """ x0 + lbd*theta in the probe's buffer """
+        return self._clamp(torch.mul(theta, float(lbd), out=self.buffer).add_(self.x0))
+
+    def points(self, theta, lbds, rows=None):
+        """ x0 + lbds[j]*theta[rows[j]] for every j (theta[j] if rows is None,
+            theta itself if it is a single direction) in the batch buffer
+        """
+        n = lbds.numel()
+        if self.batch is None or self.batch.size(0) < n:
+            self.batch = self.x0.new((n,) + tuple(self.x0.size()))
+        images = self.batch[:n]
+        lbds = lbds.type_as(images).view((n,) + (1,) * self.x0.dim())
+        if rows is not None:
+            torch.index_select(theta, 0, rows, out=images).mul_(lbds)
+        else:
+            torch.mul(theta, lbds, out=images)
+        return self._clamp(images.add_(self.x0))
+
+    def predict(self, theta, lbd):
+        return self.model.predict(self.point(theta, lbd), **self.clamped)
+
+    def predict_batch(self, theta, lbds, rows=None):
+        return predict_points(self.model, self.points(theta, lbds, rows))
+
+    def along(self, theta):
+        """ predict(lbd) for x0 + lbd*theta """
+        return lambda lbd: self.predict(theta, lbd)
+
+
+class RayCache(object):
+    """ Memo of the tightest known boundary bracket along each direction theta.
+        For every ray x0 + lbd*theta it keeps the largest lbd seen benign and
+        the smallest lbd seen adversarial, with the labels observed there.
+        Assuming the decision is monotone along the ray (as the searches
+        already do), a query outside that bracket is answered without the model.
+        is_adv: maps a predicted label to True if adversarial
+        max_rays: number of directions kept, least recently used evicted first
+    """
+    def __init__(self, model, x0, is_adv, max_rays=256):
+        self.model = model
+        self.x0 = x0
+        self.is_adv = is_adv
+        self.max_rays = max_rays
+        self.probe = RayProbe(model, x0)
+        self.rays = OrderedDict()
+        self.num_queries = 0
+        self.num_saved = 0
+
+    def along(self, theta):
+        """ predict(lbd) for x0 + lbd*theta, served from the bracket when possible """
+        key = hashlib.sha1(theta.cpu().numpy().tobytes()).hexdigest()
+        ray = self.rays.pop(key, None)
+        if ray is None:
+            ray = [0.0, None, float('inf'), None]
+        self.rays[key] = ray
+        if len(self.rays) > self.max_rays:
+            self.rays.popitem(last=False)
+
+        def predict(lbd):
+            if lbd <= ray[0] and ray[1] is not None:
+                self.num_saved += 1
+                return ray[1]
+            if lbd >= ray[2]:
+                self.num_saved += 1
+                return ray[3]
+            label = self.probe.predict(theta, lbd)
+            self.num_queries += 1
+            if self.is_adv(label):
+                ray[2], ray[3] = lbd, label
+            else:
+                ray[0], ray[1] = lbd, label
+            return label
+        return predict
+
+    def stats(self):
+        return {'queries': self.num_queries, 'saved': self.num_saved, 'rays': len(self.rays)}
+
+
+class DecisionCache(object):
+    """ Memo of hard-label decisions in front of predict and predict_batch.
+        Images are clamped to bounds (as the models do) and keyed by the sha1 of
+        their bytes, so an image queried twice costs one forward pass. Every
+        other attribute is forwarded to the wrapped model.
+        bounds: clamp range of the model, (0, 1) for MNIST/CIFAR10, (-1, 1) for IMAGENET
+        max_entries: number of decisions kept, least recently used evicted first
+        filename: .npz file the decisions are loaded from and saved to
+    """
+    def __init__(self, model, bounds=(0, 1), max_entries=1000000, filename=None):
+        self.model = model
+        self.bounds = bounds
+        self.max_entries = max_entries
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['model'], name)
+
+    def _key(self, image):
+        image = torch.clamp(image, self.bounds[0], self.bounds[1]).cpu().contiguous()
+        return hashlib.sha1(image.numpy().tobytes()).hexdigest()
+
+    def _get(self, key):
+        with self._lock:
+            label = self.entries.pop(key, None)
+            if label is None:
+                self.misses += 1
+                return None
+            self.entries[key] = label
+            self.hits += 1
+            return label
+
+    def _put(self, key, label):
+        with self._lock:
+            self.entries[key] = label
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def predict(self, image, clamped=False):
+        key = self._key(image)
+        label = self._get(key)
+        if label is None:
+            label = int(self.model.predict(image, clamped=clamped))
+            self._put(key, label)
+        return label
+
+    def predict_batch(self, image, clamped=False):
+        keys = [self._key(im) for im in image]
+        labels = [self._get(key) for key in keys]
+        missing = [i for i, label in enumerate(labels) if label is None]
+        if missing:
+            index = torch.LongTensor(missing)
+            if image.is_cuda:
+                index = index.cuda()
+            predicted = self.model.predict_batch(image.index_select(0, index), clamped=clamped).cpu().tolist()
+            for i, label in zip(missing, predicted):
+                labels[i] = label
+                self._put(keys[i], label)
+        return policy_of(self.model).tensor(torch.LongTensor(labels))
+
+    def stats(self):
+        """ Cache hits, misses (forward passes) and number of stored decisions """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        with self._lock:
+            keys = np.array(list(self.entries.keys()), dtype='S40')
+            labels = np.array(list(self.entries.values()), dtype=np.int64)
+        tmp = filename + '.tmp.npz'
+        np.savez(tmp, keys=keys, labels=labels)
+        os.rename(tmp, filename)
+
+    def load(self, filename):
+        data = np.load(filename)
+        for key, label in zip(data['keys'], data['labels']):
+            self._put(key.decode('ascii'), int(label))
+
+
+def load_decision_cache(model, name, checkpoint=None, bounds=(0, 1), cache_dir='data/cache'):
+    """ DecisionCache around model persisted in cache_dir, keyed like the
+        prediction index by the hash of the checkpoint (or of the weights)
+    """
+    key = checkpoint_hash(checkpoint) if checkpoint is not None else model_hash(model)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return DecisionCache(model, bounds, filename=os.path.join(cache_dir, '%s-%s.npz' % (name, key)))
+
+
+def attack_concurrently(model, attack, jobs, num_threads=64, max_batch_size=64, max_wait=0.002, oracle=None):
+    """ Run attack(oracle, *job) for every job on a pool of threads that share one
+        QueryBatcher, and yield (job, result) in the order the jobs were given.
+        attack: e.g. blackbox_attack.attack_untargeted
+        jobs: iterable of argument tuples following the model argument
+        oracle: QueryBatcher of model to use, whose stats() the caller can read
+                after the run; one is created (and closed) here if None
+    """
+    owned = oracle is None
+    if owned:
+        oracle = QueryBatcher(model, max_batch_size=max_batch_size, max_wait=max_wait)
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            jobs = list(jobs)
+            futures = [pool.submit(attack, oracle, *job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                yield job, future.result()
+    finally:
+        if owned:
+            oracle.close()
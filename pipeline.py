@@ -0,0 +1,115 @@
+""" Streaming pipeline of attack jobs.
+
+    The drivers used to load test image idx only once the previous attack had
+    finished. attack_jobs turns any iterable of test indices into job dicts
+    (index, image, label, target and the STEP I candidates of blackbox_attack),
+    and prefetch computes the next jobs on a background thread while the
+    current attack runs, so decoding, memmap page-in and the transfer to the
+    device overlap with the attack instead of preceding it.
+
+    Everything random about a job (its target on ImageNet, its candidates) is
+    drawn from a generator seeded by the image index, as in runner, so a job
+    does not depend on the thread or the order in which it was prepared.
+"""
+import random
+import threading
+import torch
+from queue import Queue, Full
+
+
+def choose_target(dataset, label, idx):
+    """ Target class used by the drivers for a targeted attack on test image idx """
+    if dataset == 'imagenet':
+        rng = random.Random(idx)
+        return rng.choice(list(range(label)) + list(range(label+1, 1000)))
+    return (1+label) % 10
+
+
+def load_images(dataset, indices):
+    """ Images dataset[i] for i in indices as one tensor """
+    if hasattr(dataset, 'batch'):
+        return dataset.batch(indices)[0]
+    return torch.stack([dataset[i][0] for i in indices])
+
+
+def draw_candidates(train_dataset, label, target, idx, num_samples=None, prediction_index=None):
+    """ Sorted training indices STEP I of blackbox_attack tries for test image idx
+        (num_samples: 100 targeted, 1000 untargeted as in the attacks if None)
+    """
+    rng = random.Random(idx)
+    if num_samples is None:
+        num_samples = 100 if target is not None else 1000
+    if prediction_index is not None:
+        if target is not None:
+            return prediction_index.sample(num_samples, label=target, rng=rng)
+        return prediction_index.sample(num_samples, exclude=label, rng=rng)
+    return sorted(rng.sample(range(len(train_dataset)), num_samples))
+
+
+def attack_jobs(test_dataset, indices, target_of=None, train_dataset=None, num_candidates=None, prediction_index=None, load_candidates=True, place=None):
+    """ Job dicts for the test images in indices (any iterable)
+        target_of(idx, label): target class of the job, None for an untargeted attack
+        train_dataset: draw the STEP I candidates from it (see draw_candidates);
+                       job['candidates'] is then (indices, images), the images
+                       loaded as one batch unless load_candidates is False
+        prediction_index: restrict the candidates like the attacks do; pass the
+                          same index to the attack
+        place: applied to every loaded image tensor, e.g. DevicePolicy.pin
+    """
+    place = place or (lambda images: images)
+    for idx in indices:
+        image, label = test_dataset[idx]
+        target = target_of(idx, label) if target_of is not None else None
+        candidates = None
+        if train_dataset is not None:
+            samples = draw_candidates(train_dataset, label, target, idx, num_candidates, prediction_index)
+            candidates = (samples, place(load_images(train_dataset, samples)) if load_candidates else None)
+        yield {'index': idx, 'image': place(image), 'label': label, 'target': target, 'candidates': candidates}
+
+
+def prefetch(iterable, depth=2):
+    """ Iterate over iterable while a background thread computes its next depth items """
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fill():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    thread = threading.Thread(target=fill)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def stream(jobs, attack, depth=2):
+    """ (job, attack(job)) for every job, yielded as each attack finishes while
+        the next depth jobs are prefetched
+    """
+    for job in prefetch(jobs, depth):
+        yield job, attack(job)
@@ -0,0 +1,94 @@
+""" On-disk index of a model's predicted labels on a training set.
+
+    STEP I of the attacks only needs to know which training images the model
+    puts in some class ("not y0" or "== target"). The labels are computed once
+    per model checkpoint, stored as a .npy file named after the checkpoint hash
+    and memory-mapped by every later run.
+"""
+import os
+import random
+import hashlib
+import numpy as np
+import torch
+
+
+def checkpoint_hash(filename):
+    """ sha1 of a saved checkpoint file """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+def model_hash(model):
+    """ sha1 of a model's weights, for models whose checkpoint file is not known;
+        slow on large networks, pass the checkpoint where there is one
+    """
+    net = model.model if hasattr(model, 'model') else model
+    sha = hashlib.sha1()
+    for name, tensor in sorted(net.state_dict().items()):
+        sha.update(name.encode('utf-8'))
+        sha.update(tensor.cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def build_prediction_index(model, dataset, filename, batch_size = 1000):
+    """ Predict every image of dataset with predict_batch and save the labels to filename """
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    tmp = filename + '.tmp.npy'
+    labels = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int16, shape=(len(dataset),))
+    start = 0
+    for images, _ in loader:
+        predicted = model.predict_batch(images).cpu().numpy()
+        labels[start:start+len(predicted)] = predicted
+        start += len(predicted)
+    labels.flush()
+    del labels
+    os.rename(tmp, filename)
+
+
+class PredictionIndex(object):
+    """ Memory-mapped predicted labels of a dataset
+        labels[i] is the model's prediction on dataset[i]
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.labels = np.load(filename, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def candidates(self, label = None, exclude = None):
+        """ Indices predicted as label, or as anything but exclude """
+        if label is not None:
+            return np.flatnonzero(self.labels == label)
+        return np.flatnonzero(self.labels != exclude)
+
+    def sample(self, num_samples, label = None, exclude = None, rng = random):
+        """ Sorted random subset of candidates(label, exclude) """
+        index = self.candidates(label, exclude).tolist()
+        return sorted(rng.sample(index, min(num_samples, len(index))))
+
+    def load_batch(self, dataset, indices):
+        """ Images dataset[i] for i in indices, with their predicted labels """
+        if hasattr(dataset, 'batch'):
+            images = dataset.batch(indices)[0]
+        else:
+            images = torch.stack([dataset[i][0] for i in indices])
+        return images, torch.from_numpy(self.labels[indices].astype(np.int64))
+
+
+def load_prediction_index(model, dataset, name, checkpoint = None, cache_dir = 'data/index'):
+    """ Load the index of model on dataset, building it on first use
+        name: dataset name used in the file name (mnist, cifar10, imagenet)
+        checkpoint: weights file of model; the index is keyed by its hash
+    """
+    key = checkpoint_hash(checkpoint) if checkpoint is not None else model_hash(model)
+    filename = os.path.join(cache_dir, '%s-%s.npy' % (name, key))
+    if not os.path.exists(filename):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        print("Building prediction index %s on %d images" % (filename, len(dataset)))
+        build_prediction_index(model, dataset, filename)
+    return PredictionIndex(filename)
@@ -0,0 +1,89 @@
+""" Robust accuracy at a fixed L2 radius epsilon.
+
+    The question is only whether each test image has an adversarial example
+    within distortion epsilon, so every attack runs with an epsilon Budget: it
+    stops as soon as its distortion reaches epsilon (broken), or once the
+    remaining queries cannot plausibly bring it there (robust). A misclassified
+    test image counts as broken by an untargeted attack, and by a targeted one
+    only if it is classified as the target. An image for which STEP I finds no
+    adversarial direction counts as robust. The robust accuracy and its Wilson
+    confidence interval are printed as the images finish.
+"""
+import math
+import time
+from budget import Budget
+from runner import run_pool
+from blackbox_attack import mnist_samples, cifar10_samples, imagenet_samples
+
+
+def wilson_interval(successes, n, z=1.96):
+    """ Wilson score interval of a binomial proportion (z=1.96 for 95%) """
+    if n == 0:
+        return 0.0, 1.0
+    p = float(successes) / n
+    center = (p + z*z/(2*n)) / (1 + z*z/n)
+    half = z * math.sqrt(p*(1-p)/n + z*z/(4*n*n)) / (1 + z*z/n)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class RobustAccuracy(object):
+    """ Running count of the images that resisted an attack at radius epsilon """
+    def __init__(self, epsilon, z=1.96):
+        self.epsilon = epsilon
+        self.z = z
+        self.robust = 0
+        self.total = 0
+
+    def add(self, result):
+        """ Count the result dict of an image (runner format), True if it was robust
+            A targeted attack only breaks the image if it reached the target class.
+        """
+        if result['target'] is not None:
+            fooled = result['predicted'] == result['target']
+        else:
+            fooled = result['predicted'] != result['label']
+        broken = fooled and result['distortion'] <= self.epsilon
+        self.total += 1
+        self.robust += 0 if broken else 1
+        return not broken
+
+    def accuracy(self):
+        return float(self.robust) / self.total if self.total else 0.0
+
+    def interval(self):
+        return wilson_interval(self.robust, self.total, self.z)
+
+    def __str__(self):
+        lo, hi = self.interval()
+        return "robust accuracy %.4f [%.4f, %.4f] at epsilon %.4f on %d images" % (self.accuracy(), lo, hi, self.epsilon, self.total)
+
+
+def evaluate(dataset, epsilon, samples=None, max_queries=20000, window=10, **kwargs):
+    """ Robust accuracy of the dataset's model at L2 radius epsilon, attacking
+        samples (the driver's list if None) with run_pool
+        max_queries: queries per image after which it is counted as robust
+        window: checks the give-up extrapolation of the Budget looks back over
+        kwargs: passed to run_pool (num_workers, isTarget, alpha, beta, ...)
+    """
+    if samples is None:
+        samples = {'mnist': mnist_samples, 'cifar10': cifar10_samples, 'imagenet': imagenet_samples}[dataset]
+    budget = Budget(max_queries=max_queries, epsilon=epsilon, window=window)
+    score = RobustAccuracy(epsilon)
+    timestart = time.time()
+    for n, result in enumerate(run_pool(dataset, samples, budget=budget, **kwargs)):
+        if 'error' in result:
+            print("[%d/%d] Image %d failed, not counted: %s" % (n+1, len(samples), result['index'], result['error']))
+            continue
+        robust = score.add(result)
+        status = "robust" if robust else "broken"
+        if robust and result['distortion'] == 0:
+            status = "robust (no adversarial direction found)"
+        print("[%d/%d] Image %d %s distortion %.4f in %.1f seconds, %s" % (
+            n+1, len(samples), result['index'], status, result['distortion'], result['seconds'], score))
+    print("Final %s" % score)
+    print("Total running time: %.4f seconds" % (time.time() - timestart))
+    return score
+
+
+if __name__ == '__main__':
+    evaluate('mnist', 1.5, alpha=2, beta=0.005, log_dir='logs/robust-mnist', shared=True)
@@ -0,0 +1,209 @@
+""" Attack many test images in parallel with a pool of worker processes.
+
+    The per-image attacks of blackbox_attack are independent, so the image
+    indices are sharded over num_workers processes. Every worker loads the
+    model and datasets once (in the pool initializer) and limits torch to
+    threads_per_worker intra-op threads so that the workers do not
+    oversubscribe the cores. Results stream back as images finish.
+
+    run_queue pulls the images from a WorkQueue instead, so that several nodes
+    sharing a filesystem can split a sweep and pick up each other's jobs.
+
+    With shared=True the parent loads the weights once into shared memory
+    (torch share_memory_, backed by /dev/shm) and the workers attach to them
+    instead of loading their own copies. The datasets are memory-mapped (see
+    dataset_cache) and are shared through the page cache either way.
+"""
+import os
+import sys
+import time
+import random
+import traceback
+import torch
+import torch.multiprocessing as multiprocessing
+from models import MNIST, CIFAR10, IMAGENET, DevicePolicy, unwrap, load_mnist_data, load_cifar10_data, load_imagenet_data, load_model
+import blackbox_attack
+from blackbox_attack import mnist_samples, cifar10_samples, imagenet_samples
+from work_queue import WorkQueue, LeaseKeeper, worker_name
+from pipeline import choose_target
+
+_worker = {}
+
+
+def load_setup(dataset, arch='resnet50', policy=None):
+    """ (model, train_dataset, test_dataset) as set up by the blackbox_attack drivers """
+    policy = policy or DevicePolicy()
+    if dataset == 'imagenet':
+        train_loader, test_loader, train_dataset, test_dataset = load_imagenet_data()
+        # the ImageNet driver draws STEP I candidates from the test set
+        return IMAGENET(arch, policy), test_dataset, test_dataset
+    if dataset == 'cifar10':
+        train_loader, test_loader, train_dataset, test_dataset = load_cifar10_data()
+        net, checkpoint = CIFAR10(), 'models/cifar10_gpu.pt'
+    else:
+        train_loader, test_loader, train_dataset, test_dataset = load_mnist_data()
+        net, checkpoint = MNIST(), 'models/mnist_gpu.pt'
+    net = policy.module(net)
+    load_model(net, checkpoint)
+    net.eval()
+    model = unwrap(net)
+    model.policy = policy
+    return model, train_dataset, test_dataset
+
+
+def share_setup(dataset, arch='resnet50'):
+    """ load_setup on cpu with the weights in shared memory """
+    model, train_dataset, test_dataset = load_setup(dataset, arch, DevicePolicy('cpu'))
+    (model.model if isinstance(model, IMAGENET) else model).share_memory()
+    return model, train_dataset, test_dataset
+
+
+def _init_worker(dataset, arch, device, threads_per_worker, log_dir, shared=None):
+    policy = DevicePolicy(device, num_threads=threads_per_worker)
+    if shared is not None:
+        model, train_dataset, test_dataset = shared
+    else:
+        model, train_dataset, test_dataset = load_setup(dataset, arch, policy)
+    _worker.update(dataset=dataset, model=model, train_dataset=train_dataset,
+                   test_dataset=test_dataset, log_dir=log_dir)
+
+
+def _attack_one(args):
+    """ Result dict of the attack on test image idx; a failed attack gives
+        {'index', 'label', 'target', 'error'} instead of ending the whole run
+    """
+    idx, isTarget, attack_kwargs = args
+    model, dataset = _worker['model'], _worker['dataset']
+    label, target = None, None
+    stdout = sys.stdout
+    if _worker['log_dir'] is not None:
+        sys.stdout = open(os.path.join(_worker['log_dir'], '%s-%d.log' % (dataset, idx)), 'w')
+    try:
+        image, label = _worker['test_dataset'][idx]
+        target = choose_target(dataset, label, idx) if isTarget else None
+        # same seed for an image whichever worker gets it
+        random.seed(idx)
+        torch.manual_seed(idx)
+        timestart = time.time()
+        if target is None:
+            adversarial = blackbox_attack.attack_untargeted(model, _worker['train_dataset'], image, label, **attack_kwargs)
+        else:
+            adversarial = blackbox_attack.attack_targeted(model, _worker['train_dataset'], image, label, target, **attack_kwargs)
+        seconds = time.time() - timestart
+        return {'index': idx, 'label': label, 'target': target,
+                'distortion': float(torch.norm(adversarial - image)),
+                'predicted': int(model.predict(adversarial)), 'seconds': seconds}
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        return {'index': idx, 'label': label, 'target': target, 'error': '%s: %s' % (type(e).__name__, e)}
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+
+def run_pool(dataset, samples, num_workers=None, threads_per_worker=None, isTarget=False, arch='resnet50', device='cpu', log_dir=None, shared=False, **attack_kwargs):
+    """ Attack test images samples of dataset ('mnist', 'cifar10' or 'imagenet')
+        on num_workers processes and yield one result dict per image, in the
+        order the images finish (with an 'error' key if its attack failed)
+        threads_per_worker: torch threads per process, cores/num_workers if None
+        log_dir: directory receiving each image's attack log (printed if None)
+        shared: load the weights once in this process into shared memory and
+                let the workers attach to them (cpu only)
+        attack_kwargs: passed to attack_untargeted/attack_targeted (alpha, beta, ...)
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    threads_per_worker = threads_per_worker or max(1, multiprocessing.cpu_count() // num_workers)
+    if log_dir is not None and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    setup = share_setup(dataset, arch) if shared else None
+    pool = multiprocessing.Pool(num_workers, _init_worker, (dataset, arch, device, threads_per_worker, log_dir, setup))
+    finished = False
+    try:
+        jobs = [(idx, isTarget, attack_kwargs) for idx in samples]
+        for result in pool.imap_unordered(_attack_one, jobs):
+            yield result
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def run(dataset, samples=None, **kwargs):
+    """ run_pool with the drivers' sample lists, printing results as they arrive """
+    if samples is None:
+        samples = {'mnist': mnist_samples, 'cifar10': cifar10_samples, 'imagenet': imagenet_samples}[dataset]
+    timestart = time.time()
+    total_distortion = 0.0
+    attacked = 0
+    for n, result in enumerate(run_pool(dataset, samples, **kwargs)):
+        if 'error' in result:
+            print("[%d/%d] Image %d failed: %s" % (n+1, len(samples), result['index'], result['error']))
+            continue
+        attacked += 1
+        total_distortion += result['distortion']
+        print("[%d/%d] Image %d label %d -> %d distortion %.4f in %.1f seconds" % (
+            n+1, len(samples), result['index'], result['label'], result['predicted'], result['distortion'], result['seconds']))
+    print("Average distortion on {} images is {}".format(attacked, total_distortion/max(attacked, 1)))
+    print("Total running time: %.4f seconds" % (time.time() - timestart))
+
+
+def serve_queue(filename, dataset, arch='resnet50', device='cpu', threads_per_worker=None, log_dir=None, max_jobs=None, lease_seconds=600, **attack_kwargs):
+    """ Attack the jobs of dataset leased from the WorkQueue in filename until
+        none is left (or max_jobs are done), storing each result in the queue
+    """
+    queue = WorkQueue(filename, lease_seconds)
+    if log_dir is not None and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    _init_worker(dataset, arch, device, threads_per_worker or torch.get_num_threads(), log_dir)
+    worker = worker_name()
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        job = queue.lease(dataset, worker)
+        if job is None:
+            break
+        try:
+            with LeaseKeeper(queue, job, worker):
+                result = _attack_one((job['index'], job['targeted'], attack_kwargs))
+            if 'error' in result:
+                raise RuntimeError(result['error'])
+        except Exception as e:
+            print("%s: image %d failed (attempt %d): %s" % (worker, job['index'], job['attempt'], e))
+            queue.fail(job, e, worker)
+            continue
+        if not queue.complete(job, result, worker):
+            print("%s: lease on image %d was lost, result discarded" % (worker, job['index']))
+            continue
+        done += 1
+        print("%s: image %d distortion %.4f in %.1f seconds" % (worker, job['index'], result['distortion'], result['seconds']))
+    return done
+
+
+def run_queue(filename, dataset, samples=None, isTarget=False, num_workers=1, threads_per_worker=None, **kwargs):
+    """ Queue samples (the driver's list if None, already queued jobs are kept)
+        and serve the queue from num_workers processes on this node; start the
+        same call on every node
+    """
+    if samples is None:
+        samples = {'mnist': mnist_samples, 'cifar10': cifar10_samples, 'imagenet': imagenet_samples}[dataset]
+    queue = WorkQueue(filename, kwargs.get('lease_seconds', 600))
+    queue.add(dataset, samples, isTarget)
+    threads_per_worker = threads_per_worker or max(1, multiprocessing.cpu_count() // num_workers)
+    workers = [multiprocessing.Process(target=serve_queue, args=(filename, dataset), kwargs=dict(kwargs, threads_per_worker=threads_per_worker))
+               for _ in range(num_workers)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    print("Queue %s: %s" % (filename, queue.counts()))
+    return queue.results(dataset)
+
+
+if __name__ == '__main__':
+    run('mnist', alpha=2, beta=0.005, log_dir='logs/mnist', shared=True)
+    #run('cifar10', alpha=5, beta=0.001, log_dir='logs/cifar10')
+    #run('imagenet', arch='resnet50', alpha=10, beta=0.005, iterations=1500, log_dir='logs/imagenet')
+    #run_queue('data/queue.db', 'cifar10', num_workers=8, alpha=5, beta=0.001, log_dir='logs/cifar10')
@@ -0,0 +1,89 @@
+""" Reduced-dimension perturbation subspaces.
+
+    On ImageNet the random directions of STEP II (and the ZOO coordinates) live
+    in a 3x224x224 space, although the decision boundary is mostly sensitive to
+    low-frequency changes. A subspace draws its random vectors z with shape
+    (C, s, s) for a small s and maps them to the input size with up(z); down(x, s)
+    goes the other way. The side s can grow during the attack following a
+    schedule of sizes and the iterations at which each size starts.
+"""
+import math
+import torch
+import torch.nn.functional as F
+
+interpolate = getattr(F, 'interpolate', None) or F.upsample
+
+
+def dct_matrix(n):
+    """ Orthonormal DCT-II matrix: row k is the k-th cosine basis vector of length n """
+    d = torch.zeros(n, n)
+    for k in range(n):
+        scale = math.sqrt(1.0/n) if k == 0 else math.sqrt(2.0/n)
+        for i in range(n):
+            d[k, i] = scale * math.cos(math.pi * (i + 0.5) * k / n)
+    return d
+
+
+class LowResolution(object):
+    """ Perturbations drawn at a low resolution and upsampled bilinearly
+        shape: (C, H, W) of the attacked images
+        sizes: side of the low resolution grid, one per stage
+        milestones: iteration at which each stage after the first starts
+    """
+    def __init__(self, shape, sizes=(28, 56, 112), milestones=(300, 700)):
+        self.shape = tuple(shape)
+        self.sizes = list(sizes)
+        self.milestones = list(milestones)
+
+    def size_at(self, iteration):
+        """ Side of the grid used at a given iteration of the attack """
+        stage = sum(1 for m in self.milestones if iteration >= m)
+        return self.sizes[min(stage, len(self.sizes)-1)]
+
+    def up(self, z):
+        """ (N, C, s, s) -> (N, C, H, W) """
+        return interpolate(z, size=self.shape[1:], mode='bilinear')
+
+    def down(self, x, size):
+        """ (N, C, H, W) -> (N, C, size, size) """
+        return F.adaptive_avg_pool2d(x, size)
+
+    def sample(self, iteration=0, generator=None):
+        """ Random direction of shape (C, H, W) drawn in the subspace of this
+            iteration (from generator, a torch.Generator, if given)
+        """
+        s = self.size_at(iteration)
+        return self.up(torch.randn(1, self.shape[0], s, s, generator=generator))[0]
+
+
+class LowFrequency(LowResolution):
+    """ Perturbations drawn on the s x s lowest-frequency DCT coefficients of
+        each channel and mapped back with the inverse DCT
+    """
+    def __init__(self, shape, sizes=(28, 56, 112), milestones=(300, 700)):
+        super(LowFrequency, self).__init__(shape, sizes, milestones)
+        self.dct_h = dct_matrix(self.shape[1])
+        self.dct_w = self.dct_h if self.shape[2] == self.shape[1] else dct_matrix(self.shape[2])
+
+    def _basis(self, z, size):
+        dct_h, dct_w = self.dct_h[:size], self.dct_w[:size]
+        if z.is_cuda:
+            dct_h, dct_w = dct_h.cuda(), dct_w.cuda()
+        return dct_h, dct_w
+
+    def up(self, z):
+        dct_h, dct_w = self._basis(z, z.size(-1))
+        return torch.matmul(torch.matmul(dct_h.t(), z), dct_w)
+
+    def down(self, x, size):
+        dct_h, dct_w = self._basis(x, size)
+        return torch.matmul(torch.matmul(dct_h, x), dct_w.t())
+
+
+def make_subspace(basis, shape, sizes=(28, 56, 112), milestones=(300, 700)):
+    """ Subspace by name: 'lowres' or 'dct' """
+    if basis == 'lowres':
+        return LowResolution(shape, sizes, milestones)
+    if basis == 'dct':
+        return LowFrequency(shape, sizes, milestones)
+    raise ValueError("Unknown subspace basis %s" % basis)
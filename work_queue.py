@@ -0,0 +1,158 @@
+""" Lease-based work queue of attack jobs kept in a SQLite file.
+
+    Any number of processes, on any number of machines that see the same file,
+    can pull jobs from the queue. A job is leased to one worker for
+    lease_seconds; the worker renews the lease while it is attacking and marks
+    the job done with its result. A job whose lease expires (the worker died)
+    goes back to the queue, up to max_attempts times. The database is opened in
+    rollback-journal mode because WAL needs shared memory that network
+    filesystems do not provide.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    targeted INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    UNIQUE (dataset, idx, targeted)
+)
+"""
+
+
+def worker_name():
+    """ host:pid, identifying a worker in the jobs table """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """ Jobs (dataset, test image index, targeted) with leases
+        filename: SQLite file on a filesystem shared by all nodes
+        lease_seconds: time a worker owns a job without renewing it
+        max_attempts: leases given out for a job before it is marked failed
+    """
+    def __init__(self, filename, lease_seconds=600, max_attempts=3):
+        self.filename = filename
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.execute(_schema)
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename, timeout=120, isolation_level=None)
+        db.execute("PRAGMA journal_mode=DELETE")
+        return _Transaction(db)
+
+    def add(self, dataset, samples, targeted=False):
+        """ Queue the test images samples of dataset, skipping jobs already queued """
+        with self._connect() as db:
+            db.executemany("INSERT OR IGNORE INTO jobs (dataset, idx, targeted) VALUES (?, ?, ?)",
+                           [(dataset, int(idx), int(targeted)) for idx in samples])
+
+    def lease(self, dataset, worker=None):
+        """ Lease the next pending (or expired) job of dataset, None when there is nothing left """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET status = 'failed', error = 'lease expired' "
+                       "WHERE status = 'leased' AND expires < ? AND attempts >= ?", (now, self.max_attempts))
+            row = db.execute("SELECT id, dataset, idx, targeted, attempts FROM jobs "
+                             "WHERE dataset = ? AND (status = 'pending' OR (status = 'leased' AND expires < ?)) "
+                             "ORDER BY id LIMIT 1", (dataset, now)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'leased', worker = ?, expires = ?, attempts = attempts + 1 WHERE id = ?",
+                       (worker or worker_name(), now + self.lease_seconds, row[0]))
+        return {'id': row[0], 'dataset': row[1], 'index': row[2], 'targeted': bool(row[3]), 'attempt': row[4] + 1}
+
+    def renew(self, job, worker=None):
+        """ Extend the lease of job, False if it was taken over meanwhile """
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET expires = ? WHERE id = ? AND status = 'leased' AND worker = ?",
+                                (time.time() + self.lease_seconds, job['id'], worker or worker_name()))
+            return cursor.rowcount == 1
+
+    def complete(self, job, result, worker=None):
+        """ Store the result dict of job and mark it done, False (and nothing
+            stored) if the lease was lost to another worker meanwhile
+        """
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL "
+                                "WHERE id = ? AND status = 'leased' AND worker = ?",
+                                (json.dumps(result), job['id'], worker or worker_name()))
+            return cursor.rowcount == 1
+
+    def fail(self, job, error, worker=None):
+        """ Give job back to the queue, or mark it failed after max_attempts,
+            False if the lease was lost to another worker meanwhile
+        """
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                "worker = NULL, expires = NULL, error = ? WHERE id = ? AND status = 'leased' AND worker = ?",
+                                (self.max_attempts, str(error), job['id'], worker or worker_name()))
+            return cursor.rowcount == 1
+
+    def results(self, dataset=None):
+        """ Result dicts of the finished jobs """
+        with self._connect() as db:
+            if dataset is None:
+                rows = db.execute("SELECT result FROM jobs WHERE status = 'done' ORDER BY id").fetchall()
+            else:
+                rows = db.execute("SELECT result FROM jobs WHERE status = 'done' AND dataset = ? ORDER BY id", (dataset,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def counts(self):
+        """ Number of jobs in each status """
+        with self._connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class _Transaction(object):
+    """ Connection used as one BEGIN IMMEDIATE ... COMMIT block, closed afterwards """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        finally:
+            self.db.close()
+
+
+class LeaseKeeper(object):
+    """ Renews the lease of a job from a background thread while it runs """
+    def __init__(self, queue, job, worker=None):
+        self.queue = queue
+        self.job = job
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3.0):
+            if not self.queue.renew(self.job, self.worker):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
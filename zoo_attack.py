@@ -7,7 +7,8 @@ import torchvision.datasets as dsets
 import torchvision.transforms as transforms
 from torch.autograd import Variable
 import torch.nn.functional as F
-from models import MNIST, CIFAR10, load_mnist_data, load_cifar10_data, load_model, show_image
+from models import MNIST, CIFAR10, DevicePolicy, policy_of, unwrap, load_mnist_data, load_cifar10_data, load_model, show_image
+from subspace import make_subspace
 
 alpha = 0.2
 beta = 0.001
@@ -42,42 +43,182 @@ def coordinate_ADAM(losses, indice, grad,  batch_size, mt_arr, vt_arr, real_modi
     adam_epoch[indice] = epoch + 1
 
 
-def attack(input, label, net, c, batch_size= 128, TARGETED=False):
-    input_v = Variable(input.cuda())
+def coordinate_losses(net, input_v, label_onehot_v, real_modifier, coords, c, TARGETED=False, chunk_size=512, subspace=None):
+    """ Losses of the 2*len(coords) coordinate perturbations of real_modifier,
+        ordered as in attack (+0.0001 then -0.0001 on each coordinate), computed
+        with batched forward passes of at most chunk_size images. The losses
+        are returned as a tensor on the device of input_v.
+        subspace: real_modifier holds subspace coordinates, mapped to the
+                  image with subspace.up before the forward pass
+    """
+    n = 2*len(coords)
+    flat = real_modifier.view(1, -1).repeat(n, 1)
+    rows = torch.arange(0, n).long()
+    if torch.is_tensor(coords):
+        cols = coords.cpu().view(-1, 1).repeat(1, 2).view(-1)
+    else:
+        cols = torch.from_numpy(np.repeat(coords, 2)).long()
+    sign = torch.FloatTensor([0.0001, -0.0001]).repeat(len(coords))
+    if input_v.is_cuda:
+        flat, rows, cols, sign = flat.cuda(), rows.cuda(), cols.cuda(), sign.cuda()
+    flat[rows, cols] += sign
+    modifiers = flat.view((n,) + real_modifier.size()[1:])
+    losses = []
+    with torch.no_grad():
+        for start in range(0, n, chunk_size):
+            modifier = modifiers[start:start+chunk_size]
+            modifier_v = subspace.up(modifier) if subspace is not None else modifier
+            output = net(torch.clamp(input_v + modifier_v, 0, 1))
+            real = torch.max(torch.mul(output, label_onehot_v), 1)[0]
+            other = torch.max(torch.mul(output, (1-label_onehot_v))-label_onehot_v*10000,1)[0]
+            loss1 = torch.sum((modifier_v*modifier_v).view(modifier_v.size(0), -1), 1)
+            if TARGETED:
+                loss2 = c* torch.clamp(other - real, min=0)
+            else:
+                loss2 = c* torch.clamp(real - other, min=0)
+            losses.append((loss2 + loss1).data)
+    return torch.cat(losses)
+
+
+def zoo_losses(net, input_v, label_onehot_v, real_modifier, coords, c, TARGETED=False, chunk_size=512):
+    """ coordinate_losses as a float32 numpy array, as coordinate_ADAM expects """
+    return coordinate_losses(net, input_v, label_onehot_v, real_modifier, coords, c, TARGETED, chunk_size).cpu().numpy().astype(np.float32)
+
+
+class ZooADAM(object):
+    """ Coordinate-wise ADAM whose state lives on the device of the modifier.
+        Unlike coordinate_ADAM called from attack, mt, vt and the per-coordinate
+        epochs are kept across iterations and the update is applied in place,
+        so the modifier never leaves the device.
+        importance: sample coordinates with probability proportional to a running
+                    average of their past gradient magnitude (uniform at first)
+    """
+    def __init__(self, real_modifier, lr=0.1, beta1=0.9, beta2=0.999, importance=False, decay=0.9):
+        var_size = real_modifier.numel()
+        self.lr = lr
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.importance = importance
+        self.decay = decay
+        self.mt = real_modifier.new(var_size).zero_()
+        self.vt = real_modifier.new(var_size).zero_()
+        self.epoch = real_modifier.new(var_size).fill_(1)
+        self.weight = real_modifier.new(var_size).fill_(1)
+
+    def sample(self, batch_size):
+        """ batch_size distinct coordinates, as a LongTensor on the modifier's device """
+        if self.importance:
+            return torch.multinomial(self.weight, batch_size, replacement=False)
+        index = torch.randperm(self.weight.numel())[:batch_size]
+        return index.cuda() if self.weight.is_cuda else index
+
+    def step(self, real_modifier, coords, losses):
+        """ Update real_modifier at coords from the 2*len(coords) losses of coordinate_losses """
+        losses = losses.view(-1, 2)
+        grad = (losses[:, 0] - losses[:, 1]) / 0.0002
+        mt = self.beta1 * self.mt[coords] + (1 - self.beta1) * grad
+        vt = self.beta2 * self.vt[coords] + (1 - self.beta2) * (grad * grad)
+        epoch = self.epoch[coords]
+        corr = torch.sqrt(1 - torch.pow(self.beta2, epoch)) / (1 - torch.pow(self.beta1, epoch))
+        m = real_modifier.view(-1)
+        m[coords] = m[coords] - self.lr * corr * mt / (torch.sqrt(vt) + 1e-8)
+        self.mt[coords] = mt
+        self.vt[coords] = vt
+        self.epoch[coords] = epoch + 1
+        if self.importance:
+            self.weight[coords] = self.decay * self.weight[coords] + (1 - self.decay) * grad.abs()
+            # keep every coordinate reachable
+            self.weight.clamp_(min=1e-6)
+
+
+def attack(input, label, net, c, batch_size= 128, TARGETED=False, batched=False, chunk_size=512, persistent=False, importance=False, subspace=None, policy=None, budget=None):
+    """ ZOO attack with coordinate-wise ADAM
+        batched: evaluate the 2*batch_size finite differences of an iteration
+                 together in forward passes of chunk_size images instead of one
+                 forward pass each
+        persistent: keep the ADAM state across iterations on the model's device
+                    (ZooADAM); implies batched
+        importance: with persistent, sample coordinates by past gradient magnitude
+        subspace: with persistent, optimize the coordinates of a LowResolution or
+                  LowFrequency subspace whose size follows its schedule
+        policy: DevicePolicy, the model's when None
+        budget: Budget on the 2*batch_size queries per iteration, the time and
+                the loss plateau; when it runs out the modifier with the
+                lowest loss seen is returned
+    """
+    policy = policy or policy_of(net)
+    input_v = Variable(policy.images(input))
     n_class = 10
     index = label.view(-1,1)
     label_onehot = torch.FloatTensor(input_v.size()[0] , n_class)
     label_onehot.zero_()
     label_onehot.scatter_(1,index,1)
-    label_onehot_v = Variable(label_onehot, requires_grad = False).cuda()
+    label_onehot_v = Variable(policy.images(label_onehot), requires_grad = False)
 	#print(label_onehot.scatter)
     var_size = input_v.view(-1).size()[0]
     #print(var_size)
-    real_modifier = torch.FloatTensor(input_v.size()).zero_().cuda()
+    real_modifier = policy.images(torch.FloatTensor(input_v.size()).zero_())
+    best_loss, best_modifier = float('inf'), real_modifier
+    if budget is not None:
+        budget.start()
+    if persistent:
+        size = None
+        z = real_modifier
+        optimizer = ZooADAM(z, lr=0.1, importance=importance)
+        for iter in range(200):
+            if subspace is not None and subspace.size_at(iter) != size:
+                # move to the next resolution, restarting ADAM there
+                size = subspace.size_at(iter)
+                z = real_modifier.new(input_v.size(0), input_v.size(1), size, size).zero_() if iter == 0 else subspace.down(subspace.up(z), size)
+                optimizer = ZooADAM(z, lr=0.1, importance=importance)
+            coords = optimizer.sample(batch_size)
+            losses = coordinate_losses(net, input_v, label_onehot_v, z, coords, c, TARGETED, chunk_size, subspace)
+            # the finite differences are centred on z: their mean is the loss at z
+            loss = float(losses.mean())
+            if loss < best_loss:
+                best_loss, best_modifier = loss, subspace.up(z) if subspace is not None else z.clone()
+            if budget is not None and budget.exhausted((iter+1)*2*batch_size, loss, hard_label=False):
+                print("Stopping at iteration %d: %s" % (iter+1, budget.reason))
+                return (input_v + Variable(best_modifier)).data.cpu()
+            optimizer.step(z, coords, losses)
+            if (iter+1)%20 == 0:
+                print(losses.sum())
+        real_modifier_v = Variable(subspace.up(z) if subspace is not None else z)
+        print(torch.norm(real_modifier_v))
+        return (input_v + real_modifier_v).data.cpu()
     for iter in range(200): 
         random_set = np.random.permutation(var_size)
-        losses = np.zeros(2*batch_size, dtype=np.float32)
-        #print(torch.sum(real_modifier))
-        for i in range(2*batch_size):
-            modifier = real_modifier.clone().view(-1)
-            if i%2==0:
-                modifier[random_set[i//2]] += 0.0001 
-            else:
-                modifier[random_set[i//2]] -= 0.0001
-            modifier = modifier.view(input_v.size())
-            modifier_v = Variable(modifier, requires_grad=True).cuda()
-            output = net(torch.clamp(input_v + modifier_v,0,1))
-            #print(output)
-            real = torch.max(torch.mul(output, label_onehot_v), 1)[0]
-            other = torch.max(torch.mul(output, (1-label_onehot_v))-label_onehot_v*10000,1)[0]
-            loss1 = torch.sum(modifier_v*modifier_v)/1
-            if TARGETED:
-                loss2 = c* torch.sum(torch.clamp(other - real, min=0))
-            else:
-                loss2 = c* torch.sum(torch.clamp(real - other, min=0))
-            error = loss2 + loss1 
-            #error = loss2
-            losses[i] = error.data[0]
+        if batched:
+            losses = zoo_losses(net, input_v, label_onehot_v, real_modifier, random_set[:batch_size], c, TARGETED, chunk_size)
+        else:
+            losses = np.zeros(2*batch_size, dtype=np.float32)
+            #print(torch.sum(real_modifier))
+            for i in range(2*batch_size):
+                modifier = real_modifier.clone().view(-1)
+                if i%2==0:
+                    modifier[random_set[i//2]] += 0.0001 
+                else:
+                    modifier[random_set[i//2]] -= 0.0001
+                modifier = modifier.view(input_v.size())
+                modifier_v = Variable(policy.images(modifier), requires_grad=True)
+                output = net(torch.clamp(input_v + modifier_v,0,1))
+                #print(output)
+                real = torch.max(torch.mul(output, label_onehot_v), 1)[0]
+                other = torch.max(torch.mul(output, (1-label_onehot_v))-label_onehot_v*10000,1)[0]
+                loss1 = torch.sum(modifier_v*modifier_v)/1
+                if TARGETED:
+                    loss2 = c* torch.sum(torch.clamp(other - real, min=0))
+                else:
+                    loss2 = c* torch.sum(torch.clamp(real - other, min=0))
+                error = loss2 + loss1 
+                #error = loss2
+                losses[i] = error.item()
+        loss = float(np.mean(losses))
+        if loss < best_loss:
+            best_loss, best_modifier = loss, real_modifier.clone()
+        if budget is not None and budget.exhausted((iter+1)*2*batch_size, loss, hard_label=False):
+            print("Stopping at iteration %d: %s" % (iter+1, budget.reason))
+            return (input_v + Variable(best_modifier)).data.cpu()
         if (iter+1)%1 == 0:
             print(np.sum(losses))
         #if loss2.data[0]==0:
@@ -92,13 +233,13 @@ def attack(input, label, net, c, batch_size= 128, TARGETED=False):
         #for i in range(1):
         #print(np.count_nonzero(np_modifier))
         coordinate_ADAM(losses, random_set[:batch_size], grad, batch_size, mt, vt, np_modifier, lr, adam_epoch, beta1, beta2)
-        real_modifier = torch.from_numpy(np_modifier)
-    real_modifier_v = Variable(real_modifier, requires_grad=True).cuda()
+        real_modifier = policy.images(torch.from_numpy(np_modifier))
+    real_modifier_v = Variable(real_modifier, requires_grad=True)
     print(torch.norm(real_modifier_v)) 
     return (input_v + real_modifier_v).data.cpu()
 
 
-def zoo_attack(dataset):
+def zoo_attack(dataset, batched=False, persistent=False, importance=False, basis=None, device=None, num_threads=None, budget=None):
     if dataset == 'cifar10':
         train_loader, test_loader, train_dataset, test_dataset = load_cifar10_data()
         net = CIFAR10()
@@ -106,9 +247,8 @@ def zoo_attack(dataset):
         train_loader, test_loader, train_dataset, test_dataset = load_mnist_data()
         net = MNIST()
 
-    if torch.cuda.is_available():
-        net.cuda()
-        net = torch.nn.DataParallel(net, device_ids=[0])
+    policy = DevicePolicy(device, num_threads=num_threads)
+    net = policy.module(net)
     
     if dataset == 'cifar10':
         load_model(net, 'models/cifar10_gpu.pt')
@@ -117,7 +257,8 @@ def zoo_attack(dataset):
     #save_model(net,'./models/mnist.pt')
     net.eval()
 
-    model = net.module
+    model = unwrap(net)
+    model.policy = policy
 
     #num_images = 10
     test_dataset = dsets.MNIST(root='./data/mnist', train=True, transform=transforms.ToTensor(), download=False)
@@ -128,7 +269,9 @@ def zoo_attack(dataset):
         #show_image(image.numpy())
         print("Original label:" , label)
         print("Predicted label:" , model.predict_batch(image))
-        adversarial = attack(image, label, model, 1)
+        side = image.size(-1)
+        subspace = make_subspace(basis, image.size()[1:], sizes=(side//4, side//2, side), milestones=(50, 120)) if basis is not None else None
+        adversarial = attack(image, label, model, 1, batched=batched, persistent=persistent, importance=importance, subspace=subspace, budget=budget)
         print("Predicted label for adversarial example: ", model.predict_batch(adversarial))
         #print("mindist: ", mindist)
         #print(theta)